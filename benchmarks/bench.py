@@ -0,0 +1,205 @@
+"""Time generating and uploading a synthetic album, optionally comparing with a saved baseline
+
+    python benchmarks/bench.py --images 50 --megapixels 12 --save baseline.json
+    python benchmarks/bench.py --images 50 --megapixels 12 --baseline baseline.json
+"""
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+import yaml
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from sftp_server import LocalSFTPServer  # noqa: E402
+from synthetic import make_album  # noqa: E402
+
+_logger = logging.getLogger('bench')
+
+
+def _peak_rss_mb():
+    """Peak resident set size of this process and of its largest finished child process in MB,
+    None where the resource module is not available
+    """
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    scale = 1e6 if sys.platform == 'darwin' else 1e3
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+
+def _tree(directory):
+    """Number of files and bytes in a directory tree
+    """
+    files = [file for file in Path(directory).rglob('*') if file.is_file()]
+    return len(files), sum(file.stat().st_size for file in files)
+
+
+def _measure(results, name, run, count):
+    """Time run and add the rates to results
+
+    :param run: function to time
+    :param count: function returning the files and bytes processed, called after run
+    """
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    files, size = count()
+    rss, child_rss = _peak_rss_mb()
+    results[name] = {'seconds': round(seconds, 4), 'files': files, 'bytes': size,
+                     'files_per_s': round(files / seconds, 2) if seconds else None,
+                     'mb_per_s': round(size / 1e6 / seconds, 2) if seconds else None,
+                     'peak_rss_mb': rss, 'peak_child_rss_mb': child_rss}
+    _logger.info(f"{name} took {seconds:.2f}s")
+
+
+def _sent(maker, before):
+    """Files and bytes uploaded since before, from the profiler's put stage
+    """
+    put = maker.profiler.stages.get('put', {'count': 0, 'sent': 0})
+    return put['count'] - before[0], put['sent'] - before[1]
+
+
+def _build(maker):
+    """Make the derivatives and pages of every album, as generate does after scanning
+    """
+    albums = list(maker._all_albums())
+    with maker._executor() as executor:
+        for album in albums:
+            album._plan_derivatives(executor)
+        for album in albums:
+            album.make_index(album.output_dir)
+
+
+def run(workdir, images, megapixels, movies, movie_mb, docs, seed, jobs, connections, cache):
+    """Make the album if needed and time each stage of generating and uploading it
+
+    :return: dictionary of stage name to timings and rates
+    """
+    workdir = Path(workdir)
+    input_dir = workdir / 'input' / 'Bench Album'
+    _logger.info(f"Making the album in {input_dir}")
+    source_files = images + movies + docs
+    source_bytes = make_album(input_dir, images, megapixels, movies, movie_mb, docs, seed)
+
+    # A home of its own so the benchmark never touches the real config
+    home = workdir / 'home'
+    output_dir = workdir / 'albums'
+    remote_dir = workdir / 'remote'
+    for directory in (home, output_dir, remote_dir):
+        shutil.rmtree(directory, ignore_errors=True)
+        directory.mkdir(parents=True)
+    os.environ['HOME'] = os.environ['USERPROFILE'] = str(home)
+
+    from maker import AlbumMaker
+    from profiler import Profiler
+
+    results = {}
+    with LocalSFTPServer(remote_dir) as server:
+        (home / '.amaker').mkdir()
+        with (home / '.amaker' / 'config.yml').open('w') as outfile:
+            yaml.dump({'target': {'directory': '/www', 'server': '127.0.0.1', 'port': server.port,
+                                  'username': 'bench', 'password': '', 'url': 'http://localhost'},
+                       'who': ['bench'], 'style': 'bootstrap', 'local_dir': str(output_dir),
+                       'cache_dir': str(workdir / 'cache'), 'cache_mb': 2000 if cache else 0}, outfile)
+        if not cache:
+            shutil.rmtree(workdir / 'cache', ignore_errors=True)
+        (remote_dir / 'www').mkdir()
+        maker = AlbumMaker().configure(None, input_dir, None, 'bench', jobs)
+        maker.profiler = Profiler(enabled=True)
+
+        _measure(results, 'scan_input_dir', maker.scan_input_dir, lambda: (len(maker.files), source_bytes))
+        _measure(results, 'make_index', lambda: _build(maker), lambda: (source_files, source_bytes))
+        _measure(results, 'copy_resources', lambda: maker.copy_resources(maker.output_dir),
+                 lambda: _tree(maker.output_dir / 'resources'))
+        _measure(results, 'upload', lambda: maker.upload(delta=False, delete=False, connections=connections),
+                 lambda: _sent(maker, (0, 0)))
+        maker.scan_input_dir()
+        _measure(results, 'make_index unchanged', lambda: _build(maker), lambda: (source_files, source_bytes))
+        before = _sent(maker, (0, 0))
+        _measure(results, 'upload unchanged', lambda: maker.upload(delta=True, delete=False, connections=connections),
+                 lambda: _sent(maker, before))
+    return results
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    """Print how each stage compares with the baseline
+
+    :param tolerance: fraction slower than the baseline that counts as a regression
+    :param min_seconds: differences smaller than this are noise and never count as a regression
+    :return: names of the stages that regressed
+    """
+    regressed = []
+    print(f"{'Stage':<24}{'Baseline s':>12}{'Now s':>10}{'Change':>9}")
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None or not before['seconds']:
+            continue
+        change = result['seconds'] / before['seconds'] - 1
+        flag = ''
+        if change > tolerance and result['seconds'] - before['seconds'] > min_seconds:
+            regressed.append(name)
+            flag = '  SLOWER'
+        print(f"{name:<24}{before['seconds']:>12.3f}{result['seconds']:>10.3f}{change:>+9.0%}{flag}")
+    return regressed
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark generating and uploading a synthetic album')
+    parser.add_argument('--workdir', default=str(Path(tempfile.gettempdir()) / 'albummaker-bench'),
+                        help='Directory for the album, output and remote copy, the album is kept between runs')
+    parser.add_argument('--images', type=int, default=50)
+    parser.add_argument('--megapixels', type=float, default=12)
+    parser.add_argument('--movies', type=int, default=2)
+    parser.add_argument('--movie_mb', type=int, default=20)
+    parser.add_argument('--docs', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--connections', type=int, default=4)
+    parser.add_argument('--cache', action='store_true', help='Use the derivative cache, kept between runs')
+    parser.add_argument('--save', help='Write the results to this JSON file, for use as a baseline')
+    parser.add_argument('--baseline', help='JSON file from --save to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Fraction slower than the baseline to report as a regression')
+    parser.add_argument('--min_seconds', type=float, default=0.05,
+                        help='Slow downs smaller than this many seconds are not reported as regressions')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    _logger.setLevel(logging.INFO)
+
+    settings = {name: getattr(args, name) for name in ('images', 'megapixels', 'movies', 'movie_mb', 'docs', 'seed',
+                                                       'jobs', 'connections', 'cache')}
+    results = run(args.workdir, **settings)
+
+    print(f"{'Stage':<24}{'Seconds':>9}{'Files':>7}{'Files/s':>9}{'MB':>9}{'MB/s':>9}{'Peak RSS MB':>13}")
+    for name, result in results.items():
+        print(f"{name:<24}{result['seconds']:>9.3f}{result['files']:>7}{result['files_per_s'] or 0:>9.1f}"
+              f"{result['bytes'] / 1e6:>9.1f}{result['mb_per_s'] or 0:>9.1f}{result['peak_rss_mb'] or 0:>13.0f}")
+
+    report = {'settings': settings, 'python': platform.python_version(), 'platform': platform.platform(),
+              'results': results}
+    if args.save:
+        with open(args.save, 'w') as outfile:
+            json.dump(report, outfile, indent=1)
+    if args.baseline:
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)
+        if baseline['settings'] != settings:
+            print(f"Baseline was run with different settings: {baseline['settings']}")
+        if compare(results, baseline['results'], args.tolerance, args.min_seconds):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import os
+import socket
+import threading
+import logging
+import paramiko
+
+# The server side logs an error whenever a client disconnects, keep those out of the results
+logging.getLogger('sftp_server').setLevel(logging.CRITICAL)
+
+
+def _sftp_errors(method):
+    """Turn OSError from the local filesystem into the SFTP error code
+    """
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+    return wrapper
+
+
+class _Server(paramiko.ServerInterface):
+    """Accept any password
+    """
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class _Handle(paramiko.SFTPHandle):
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+class _SFTPInterface(paramiko.SFTPServerInterface):
+    """SFTP on a local directory, enough of it for the uploader
+    """
+
+    root = None
+
+    def _local(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+    def canonicalize(self, path):
+        return os.path.normpath('/' + path).replace('\\', '/').replace('//', '/')
+
+    @_sftp_errors
+    def list_folder(self, path):
+        local = self._local(path)
+        listing = []
+        for name in os.listdir(local):
+            attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(local, name)))
+            attr.filename = name
+            listing.append(attr)
+        return listing
+
+    @_sftp_errors
+    def stat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.stat(self._local(path)))
+
+    @_sftp_errors
+    def lstat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.lstat(self._local(path)))
+
+    @_sftp_errors
+    def open(self, path, flags, attr):
+        fd = os.open(self._local(path), flags | getattr(os, 'O_BINARY', 0), 0o644)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = _Handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    @_sftp_errors
+    def remove(self, path):
+        os.remove(self._local(path))
+        return paramiko.SFTP_OK
+
+    @_sftp_errors
+    def rename(self, oldpath, newpath):
+        if os.path.exists(self._local(newpath)):
+            return paramiko.SFTP_FAILURE
+        os.rename(self._local(oldpath), self._local(newpath))
+        return paramiko.SFTP_OK
+
+    @_sftp_errors
+    def posix_rename(self, oldpath, newpath):
+        os.replace(self._local(oldpath), self._local(newpath))
+        return paramiko.SFTP_OK
+
+    @_sftp_errors
+    def mkdir(self, path, attr):
+        os.mkdir(self._local(path))
+        return paramiko.SFTP_OK
+
+    @_sftp_errors
+    def rmdir(self, path):
+        os.rmdir(self._local(path))
+        return paramiko.SFTP_OK
+
+    @_sftp_errors
+    def chattr(self, path, attr):
+        if attr.st_mtime is not None:
+            os.utime(self._local(path), (attr.st_atime, attr.st_mtime))
+        return paramiko.SFTP_OK
+
+
+class LocalSFTPServer:
+    """SFTP server on localhost serving a local directory, run on a thread in this process as a stand in
+    for the real server. Any username and password are accepted.
+    """
+
+    def __init__(self, root):
+        """
+        :param root: directory served as /
+        """
+        self.root = str(root)
+        self._host_key = paramiko.RSAKey.generate(2048)
+        self._socket = None
+        self._transports = []
+
+    def __enter__(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(5)
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
+
+    def _accept(self):
+        interface = type('SFTPInterface', (_SFTPInterface,), {'root': self.root})
+        while True:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(connection)
+            transport.set_log_channel('sftp_server')
+            transport.add_server_key(self._host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, interface)
+            transport.start_server(server=_Server())
+            self._transports.append(transport)
@@ -0,0 +1,56 @@
+import json
+import random
+import shutil
+from pathlib import Path
+from PIL import Image
+
+ORIENTATION = 0x0112
+MINIMAL_PDF = b'%PDF-1.4\n1 0 obj << /Type /Catalog >> endobj\ntrailer << /Root 1 0 R >>\n%%EOF\n'
+
+
+def _photo(size, rng):
+    """Something like a photo, smooth areas with noise, so it decodes and encodes at a realistic speed
+    """
+    gradient = Image.linear_gradient('L').rotate(rng.randrange(360)).resize(size)
+    radial = Image.radial_gradient('L').resize(size)
+    noise = Image.effect_noise(size, rng.uniform(20, 60))
+    return Image.merge('RGB', (gradient, radial, noise))
+
+
+def make_album(input_dir, images=50, megapixels=12, movies=2, movie_mb=20, docs=2, seed=1):
+    """Make an album of JPEGs with random EXIF orientations, movies and docs. Kept if one with the same
+    settings is already there so repeat runs measure the same input.
+
+    :param input_dir: directory to make the album in, emptied first if the settings differ
+    :param images: number of JPEGs
+    :param megapixels: size of each JPEG, 4:3
+    :param movies: number of movies, random bytes
+    :param movie_mb: size of each movie
+    :param docs: number of PDFs
+    :param seed: seed for the orientations and sizes
+    :return: total size of the album in bytes
+    """
+    input_dir = Path(input_dir)
+    settings = {'images': images, 'megapixels': megapixels, 'movies': movies, 'movie_mb': movie_mb, 'docs': docs,
+                'seed': seed}
+    settings_file = input_dir.parent / f'.{input_dir.name}.json'
+    if input_dir.exists() and settings_file.exists() and json.loads(settings_file.read_text()) == settings:
+        return sum(file.stat().st_size for file in input_dir.iterdir())
+    shutil.rmtree(input_dir, ignore_errors=True)
+    input_dir.mkdir(parents=True)
+
+    rng = random.Random(seed)
+    height = int((megapixels * 1e6 * 3 / 4) ** 0.5)
+    size = (height * 4 // 3, height)
+    for number in range(images):
+        exif = Image.Exif()
+        exif[ORIENTATION] = rng.randint(1, 8)
+        _photo(size, rng).save(input_dir / f'photo{number:04d}.jpg', quality=90, exif=exif.tobytes())
+    for number in range(movies):
+        with (input_dir / f'movie{number:02d}.mp4').open('wb') as outfile:
+            for _ in range(movie_mb):
+                outfile.write(rng.randbytes(1000000))
+    for number in range(docs):
+        (input_dir / f'doc{number:02d}.pdf').write_bytes(MINIMAL_PDF + b'%' * rng.randrange(10000, 100000))
+    settings_file.write_text(json.dumps(settings))
+    return sum(file.stat().st_size for file in input_dir.iterdir())
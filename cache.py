@@ -0,0 +1,115 @@
+import os
+import json
+import shutil
+import time
+import hashlib
+import logging
+from pathlib import Path
+
+_logger = logging.getLogger('maker')
+
+
+def _link_or_copy(source, target):
+    """Hard link source to target, copying if they are on different filesystems. Any existing target
+    is replaced rather than written to, as it may be a link to another file.
+    """
+    tmp = target.with_name(f'.{target.name}.{os.getpid()}.tmp')
+    tmp.unlink(missing_ok=True)
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copy2(source, tmp)
+    os.replace(tmp, target)
+    # Renaming onto another link to the same file does nothing and leaves tmp behind
+    tmp.unlink(missing_ok=True)
+
+
+class DerivativeCache:
+    """Resized images and thumbnails shared between albums and people, keyed by the content of the source
+    and the settings they were made with. The least recently used files are removed when the cache is over
+    its size limit. Use is recorded in the access time, the modification time is left alone as the files are
+    hard linked into albums and the uploader compares it.
+    """
+
+    def __init__(self, cache_dir):
+        self._cache_dir = Path(cache_dir)
+
+    @staticmethod
+    def key(content_hash, settings):
+        """Cache key for derivatives of a source
+
+        :param content_hash: hash of the source's contents
+        :param settings: dictionary of everything else that affects the output, sizes and encoder settings
+        """
+        return hashlib.sha256(json.dumps([content_hash, settings], sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key, suffix):
+        return self._cache_dir / key[:2] / f'{key}{suffix}'
+
+    def fetch(self, key, output_dir, outputs_for):
+        """Put cached derivatives in place
+
+        :param output_dir: album output directory to put them in
+        :param outputs_for: function from the stored sizes to the paths to put the derivatives at,
+                            relative to output_dir, in the order they were stored
+        :return: the sizes given to store, or None if they are not all in the cache
+        """
+        index = self._path(key, '.json')
+        try:
+            with index.open() as infile:
+                data = json.load(infile)
+        except (OSError, ValueError):
+            return None
+        outputs = outputs_for(data['sizes'])
+        cached = [self._path(key, f'.{number}{Path(output).suffix}') for number, output in enumerate(outputs)]
+        if not all(path.exists() for path in cached):
+            return None
+        for path, output in zip(cached, outputs):
+            _link_or_copy(path, Path(output_dir) / output)
+            self._touch(path)
+        self._touch(index)
+        return data['sizes']
+
+    @staticmethod
+    def _touch(path):
+        """Mark a file as recently used
+        """
+        os.utime(path, ns=(time.time_ns(), path.stat().st_mtime_ns))
+
+    def store(self, key, output_dir, sizes, outputs):
+        """Add newly made derivatives to the cache
+
+        :param output_dir: album output directory they were made in
+        :param sizes: dimensions and anything else to return from fetch, independent of the source's name
+        :param outputs: paths of the derivatives relative to output_dir
+        """
+        index = self._path(key, '.json')
+        index.parent.mkdir(parents=True, exist_ok=True)
+        for number, output in enumerate(outputs):
+            _link_or_copy(Path(output_dir) / output, self._path(key, f'.{number}{Path(output).suffix}'))
+        # Written last so a fetch never finds an index without its files
+        tmp = index.with_name(f'.{index.name}.{os.getpid()}.tmp')
+        with tmp.open('w') as outfile:
+            json.dump({'sizes': sizes}, outfile)
+        os.replace(tmp, index)
+
+    def evict(self, max_bytes):
+        """Remove the least recently used files until the cache is no bigger than max_bytes
+        """
+        if not self._cache_dir.exists():
+            return
+        files = []
+        for directory in self._cache_dir.iterdir():
+            if directory.is_dir():
+                files.extend((stat.st_atime, stat.st_size, path) for path, stat in
+                             ((path, path.stat()) for path in directory.iterdir()))
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for _, size, path in sorted(files):
+            if total <= max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        if removed:
+            _logger.info(f"Removed {removed} files from the cache, {total / 1e6:.0f} MB left")
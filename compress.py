@@ -0,0 +1,73 @@
+import gzip
+import re
+from importlib.util import find_spec
+from pathlib import Path
+
+# Files worth sending compressed, the images are compressed already
+COMPRESSIBLE = {'.html', '.css', '.json', '.js', '.svg'}
+# Suffixes of the precompressed copies written next to a file
+COMPRESSED_SUFFIXES = ('.gz', '.br')
+
+# Text inside these is left as it is
+_PRESERVE = re.compile(r'(<(script|pre|textarea|style)\b.*?</\2\s*>)', re.IGNORECASE | re.DOTALL)
+_COMMENT = re.compile(r'<!--.*?-->', re.DOTALL)
+_SPACE = re.compile(r'\s+')
+
+
+def minify_html(content):
+    """Leave out comments and collapse each run of white space to one space. Spaces between tags
+    are kept as they may separate inline elements, and scripts and preformatted text are left alone.
+    """
+    parts = _PRESERVE.split(content)
+    minified = []
+    # split gives the text, then the preserved block and its tag name for each match
+    for number, part in enumerate(parts):
+        if number % 3 == 0:
+            minified.append(_SPACE.sub(' ', _COMMENT.sub('', part)))
+        elif number % 3 == 1:
+            minified.append(part)
+    return ''.join(minified).strip()
+
+
+def precompress(file):
+    """Write gzip and, if brotli is installed, brotli compressed copies next to a file, for a web server
+    set up to send them to browsers that accept them instead of compressing each response
+
+    :return: total bytes written
+    """
+    file = Path(file)
+    data = file.read_bytes()
+    compressed = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    if find_spec('brotli'):
+        import brotli
+        compressed['.br'] = brotli.compress(data)
+    for suffix in COMPRESSED_SUFFIXES:
+        copy = file.with_name(file.name + suffix)
+        if suffix in compressed:
+            copy.write_bytes(compressed[suffix])
+        else:
+            copy.unlink(missing_ok=True)
+    return sum(len(content) for content in compressed.values())
+
+
+def precompressed(file):
+    """True if a file has a gzip copy at least as new as it
+    """
+    file = Path(file)
+    copy = file.with_name(file.name + '.gz')
+    return copy.exists() and copy.stat().st_mtime >= file.stat().st_mtime
+
+
+def compressed_copies(file):
+    """Compressed copies of a file that exist
+    """
+    file = Path(file)
+    return [copy for copy in (file.with_name(file.name + suffix) for suffix in COMPRESSED_SUFFIXES) if copy.exists()]
+
+
+def remove_compressed(file):
+    """Remove the compressed copies of a file
+    """
+    file = Path(file)
+    for suffix in COMPRESSED_SUFFIXES:
+        file.with_name(file.name + suffix).unlink(missing_ok=True)
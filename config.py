@@ -1,3 +1,5 @@
+import os
+import shutil
 import yaml
 import base64
 from pathlib import Path
@@ -15,20 +17,38 @@ class AlbumMakerConfig:
             config_file = config_path / Path('config.yml')
             if not config_path.exists():
                 config_path.mkdir()
-            if config_file.exists():
-                with open(config_file) as infile:
-                    self._config = yaml.safe_load(infile)
-            else:
-                self._config = {}
+        config_file = Path(config_file)
+        self._config = {}
+        if config_file.exists():
+            with open(config_file) as infile:
+                self._config = yaml.safe_load(infile) or {}
 
         self._yaml_file = config_file
         self._image_suffix = self._config.get('image_suffix', ['.jpg'])
         self._movie_suffix = self._config.get('movie_suffix', ['.mov', '.mp4'])
         self._doc_suffix = self._config.get('doc_suffix', ['.pdf'])
+        self._recursive = self._config.get('recursive', False)
+        self._sub_albums = self._config.get('sub_albums', False)
         self._per_page = self._config.get('per_page', 12)
+        self._page_mode = self._config.get('page_mode', 'html')
         self._style = self._config.get('style', 'boostrap')
         self._thumbnail_size = self._config.get('thumbnail_size', [240, 240])
         self._image_size = self._config.get('image_size', [500, 500])
+        self._thumbnail_kb = self._config.get('thumbnail_kb', 16)
+        self._image_kb = self._config.get('image_kb', 80)
+        self._image_formats = self._config.get('image_formats', ['webp'])
+        self._image_scales = self._config.get('image_scales', [0.5, 1])
+        self._image_quality = self._config.get('image_quality', {})
+        self._jobs = self._config.get('jobs', 1)
+        self._memory_budget_mb = self._config.get('memory_budget_mb', 2000)
+        self._max_image_pixels = self._config.get('max_image_pixels', 250000000)
+        self._previews = self._config.get('previews', True)
+        self._precompress = self._config.get('precompress', True)
+        self._dedupe = self._config.get('dedupe', 'off')
+        self._dedupe_distance = self._config.get('dedupe_distance', 4)
+        self._link_mode = self._config.get('link_mode', 'copy')
+        self._cache_dir = self._config.get('cache_dir', str(Path.home() / Path('.amaker') / Path('cache')))
+        self._cache_mb = self._config.get('cache_mb', 2000)
         self._local_dir = self._config.get('local_dir', str(Path.home() / Path('albums')))
         self._target = self._config.get('target', {})
         self._target_password = self._target.get('password')
@@ -37,6 +57,14 @@ class AlbumMakerConfig:
         self._target_port = self._target.get('port', 22)
         self._target_url = self._target.get('url')
         self._target_username = self._target.get('username')
+        self._delta_upload = self._config.get('delta_upload', False)
+        self._delete_remote = self._config.get('delete_remote', False)
+        self._upload_connections = self._config.get('upload_connections', 4)
+        self._upload_retries = self._config.get('upload_retries', 3)
+        self._bulk_upload = self._config.get('bulk_upload', False)
+        self._bulk_compress = self._config.get('bulk_compress', False)
+        self._watch_settle = self._config.get('watch_settle', 5)
+        self._watch_interval = self._config.get('watch_interval', 2)
         self._who = self._config.get('who', ['noname'])
         self.save()
 
@@ -64,6 +92,22 @@ class AlbumMakerConfig:
     def doc_suffix(self):
         return self._doc_suffix
 
+    @property
+    def recursive(self):
+        return self._recursive
+
+    @recursive.setter
+    def recursive(self, value):
+        self._recursive = value
+
+    @property
+    def sub_albums(self):
+        return self._sub_albums
+
+    @sub_albums.setter
+    def sub_albums(self, value):
+        self._sub_albums = value
+
     @property
     def per_page(self):
         return self._per_page
@@ -92,6 +136,152 @@ class AlbumMakerConfig:
     def image_size(self, value):
         self._image_size = value
 
+    @property
+    def thumbnail_kb(self):
+        """Size in KB to encode thumbnails to by lowering their quality, 0 to use the quality as it is
+        """
+        return self._thumbnail_kb
+
+    @thumbnail_kb.setter
+    def thumbnail_kb(self, value):
+        self._thumbnail_kb = value
+
+    @property
+    def image_kb(self):
+        """Size in KB to encode resized images to, smaller scales get a share by area, 0 for no target
+        """
+        return self._image_kb
+
+    @image_kb.setter
+    def image_kb(self, value):
+        self._image_kb = value
+
+    @property
+    def image_formats(self):
+        """Formats to make as well as the format of the source, for browsers that support them
+        """
+        return self._image_formats
+
+    @image_formats.setter
+    def image_formats(self, value):
+        self._image_formats = value
+
+    @property
+    def image_scales(self):
+        """Sizes of image to make relative to image_size, for the browser to choose from
+        """
+        return self._image_scales
+
+    @image_scales.setter
+    def image_scales(self, value):
+        self._image_scales = value
+
+    @property
+    def image_quality(self):
+        """Dictionary of lower case format to encoder quality
+        """
+        return self._image_quality
+
+    @property
+    def jobs(self):
+        return self._jobs
+
+    @jobs.setter
+    def jobs(self, value):
+        self._jobs = value
+
+    @property
+    def memory_budget_mb(self):
+        """Estimated memory the images being made at once may use in MB, fewer are made in parallel if needed
+        """
+        return self._memory_budget_mb
+
+    @memory_budget_mb.setter
+    def memory_budget_mb(self, value):
+        self._memory_budget_mb = value
+
+    @property
+    def max_image_pixels(self):
+        """Most pixels to decode an image at, after JPEGs are scaled down while decoding
+        """
+        return self._max_image_pixels
+
+    @property
+    def page_mode(self):
+        """html for a page per index page and per item, json for album.json and one viewer page
+        """
+        return self._page_mode
+
+    @page_mode.setter
+    def page_mode(self, value):
+        if value not in ('html', 'json'):
+            raise ValueError(f"{value} is not html or json")
+        self._page_mode = value
+
+    @property
+    def dedupe(self):
+        """off, flag to log files that duplicate another in the album, or collapse to also leave them out
+        """
+        return self._dedupe
+
+    @dedupe.setter
+    def dedupe(self, value):
+        if value not in ('off', 'flag', 'collapse'):
+            raise ValueError(f"{value} is not off, flag or collapse")
+        self._dedupe = value
+
+    @property
+    def dedupe_distance(self):
+        """Most bits the perceptual hashes of two images differ by for them to count as duplicates
+        """
+        return self._dedupe_distance
+
+    @property
+    def previews(self):
+        """Make poster frames of movies with ffmpeg and pictures of the first page of PDFs, when installed
+        """
+        return self._previews
+
+    @previews.setter
+    def previews(self, value):
+        self._previews = value
+
+    @property
+    def precompress(self):
+        """Write gzip and brotli copies of pages and stylesheets for the web server to send
+        """
+        return self._precompress
+
+    @precompress.setter
+    def precompress(self, value):
+        self._precompress = value
+
+    @property
+    def link_mode(self):
+        return self._link_mode
+
+    @link_mode.setter
+    def link_mode(self, value):
+        self._link_mode = value
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    @cache_dir.setter
+    def cache_dir(self, value):
+        self._cache_dir = value
+
+    @property
+    def cache_mb(self):
+        """Size limit of the derivative cache in MB, 0 to not use the cache
+        """
+        return self._cache_mb
+
+    @cache_mb.setter
+    def cache_mb(self, value):
+        self._cache_mb = value
+
     @property
     def who(self):
         return self._who
@@ -142,6 +332,62 @@ class AlbumMakerConfig:
     def target_port(self):
         return self._target_port
 
+    @property
+    def delta_upload(self):
+        return self._delta_upload
+
+    @delta_upload.setter
+    def delta_upload(self, value):
+        self._delta_upload = value
+
+    @property
+    def delete_remote(self):
+        return self._delete_remote
+
+    @delete_remote.setter
+    def delete_remote(self, value):
+        self._delete_remote = value
+
+    @property
+    def upload_connections(self):
+        return self._upload_connections
+
+    @upload_connections.setter
+    def upload_connections(self, value):
+        self._upload_connections = value
+
+    @property
+    def upload_retries(self):
+        return self._upload_retries
+
+    @property
+    def bulk_upload(self):
+        """Upload albums as one tar unpacked on the server where it allows running commands
+        """
+        return self._bulk_upload
+
+    @bulk_upload.setter
+    def bulk_upload(self, value):
+        self._bulk_upload = value
+
+    @property
+    def bulk_compress(self):
+        """Gzip the tar of a bulk upload
+        """
+        return self._bulk_compress
+
+    @property
+    def watch_settle(self):
+        """Seconds an input directory must go without changes before watch publishes it
+        """
+        return self._watch_settle
+
+    @property
+    def watch_interval(self):
+        """Seconds between checks for changes when watchdog is not installed
+        """
+        return self._watch_interval
+
     def _create_empty_config(self, config_file):
         """
         """
@@ -153,12 +399,41 @@ class AlbumMakerConfig:
             yaml.dump(data, outfile)
 
     def save(self):
+        """Write the config if it differs from the file, to a temporary file that then replaces it so
+        the file is never left half written. Settings this version doesn't know about are kept, and the
+        file keeps its permissions or is only readable by its owner when new, as it holds the password.
         """
+        data = self._data()
+        data = {**self._config, **data, 'target': {**self._target, **data['target']}}
+        if data == self._config:
+            return
+        tmp = self._yaml_file.with_name(f'.{self._yaml_file.name}.tmp')
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as outfile:
+            yaml.dump(data, outfile)
+        if self._yaml_file.exists():
+            shutil.copymode(self._yaml_file, tmp)
+        os.replace(tmp, self._yaml_file)
+        self._config = data
+
+    def _data(self):
+        """The settings as they are saved
         """
-        with self._yaml_file.open('w') as outfile:
-            yaml.dump({'target': {'directory': self._target_directory, 'password': self._target_password,
-                                  'username': self._target_username, 'url': self._target_url,
-                                  'server': self._target_server, 'port': self._target_port},
-                       'who': self.who, 'per_page': self.per_page, 'image_size': self.image_size,
-                       'thumbnail_size': self.thumbnail_size, 'style': self.style, 'local_dir': str(self.local_dir),
-                       }, outfile)
+        return {'target': {'directory': self._target_directory, 'password': self._target_password,
+                           'username': self._target_username, 'url': self._target_url,
+                           'server': self._target_server, 'port': self._target_port},
+                'who': self.who, 'image_suffix': self.image_suffix, 'movie_suffix': self.movie_suffix,
+                'doc_suffix': self.doc_suffix, 'per_page': self.per_page, 'page_mode': self.page_mode,
+                'image_size': self.image_size, 'thumbnail_size': self.thumbnail_size,
+                'image_kb': self.image_kb, 'thumbnail_kb': self.thumbnail_kb,
+                'image_formats': self.image_formats, 'image_scales': self.image_scales,
+                'image_quality': self.image_quality, 'style': self.style, 'local_dir': str(self.local_dir),
+                'recursive': self.recursive, 'sub_albums': self.sub_albums, 'jobs': self.jobs,
+                'memory_budget_mb': self.memory_budget_mb, 'max_image_pixels': self.max_image_pixels,
+                'previews': self.previews, 'precompress': self.precompress, 'dedupe': self.dedupe,
+                'dedupe_distance': self.dedupe_distance,
+                'link_mode': self.link_mode, 'cache_dir': self.cache_dir, 'cache_mb': self.cache_mb,
+                'delta_upload': self.delta_upload, 'delete_remote': self.delete_remote,
+                'upload_connections': self.upload_connections, 'upload_retries': self.upload_retries,
+                'bulk_upload': self.bulk_upload, 'bulk_compress': self.bulk_compress,
+                'watch_settle': self.watch_settle, 'watch_interval': self.watch_interval,
+                }
@@ -0,0 +1,141 @@
+import json
+import logging
+from pathlib import Path
+
+from manifest import file_hash
+
+_logger = logging.getLogger('maker')
+
+HASH_SIZE = 8
+
+
+def _open_drafted(file):
+    """Open an image set to decode small enough for a hash, a JPEG at an eighth of its size or less. Other
+    formats are decoded at full size.
+    """
+    from PIL import Image
+    # Checked against max_image_pixels at the size the image is decoded at instead, as in maker
+    Image.MAX_IMAGE_PIXELS = None
+    im = Image.open(file)
+    im.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+    return im
+
+
+def hash_cost(file, file_type, max_pixels=None):
+    """Estimate of the memory content_hashes takes, reading only the header
+
+    :return: bytes, the decoded image and one copy of it at 4 bytes a pixel, 0 if it won't be decoded
+    """
+    if file_type != 'image':
+        return 0
+    try:
+        with _open_drafted(file) as im:
+            pixels = im.width * im.height
+    except (OSError, ValueError):
+        return 0
+    return 0 if max_pixels and pixels > max_pixels else pixels * 4 * 2
+
+
+def content_hashes(file, file_type, max_pixels=None):
+    """sha256 of a file and, for an image, a perceptual difference hash of it the right way up. Module
+    level so it can be run in a worker process.
+
+    :param max_pixels: largest number of pixels to decode, bigger images get no perceptual hash
+    :return: (sha256, difference hash as an int or None)
+    """
+    sha256 = file_hash(file)
+    if file_type != 'image':
+        return sha256, None
+    from PIL import Image, ImageOps
+    try:
+        with _open_drafted(file) as im:
+            if max_pixels and im.width * im.height > max_pixels:
+                _logger.warning(f"{Path(file).name} needs {im.width * im.height / 1e6:.0f} megapixels decoding, "
+                                f"more than max_image_pixels, only finding exact copies of it")
+                return sha256, None
+            small = ImageOps.exif_transpose(im).convert('L').resize((HASH_SIZE + 1, HASH_SIZE),
+                                                                    Image.Resampling.BOX)
+    except (OSError, ValueError) as e:
+        _logger.warning(f"Can't read {Path(file).name} to compare it with the other images: {e}")
+        return sha256, None
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + column]
+            bits = bits << 1 | (left > pixels[row * (HASH_SIZE + 1) + column + 1])
+    return sha256, bits
+
+
+class DuplicateFinder:
+    """Find sources with the same content, and images that look the same by a perceptual hash. Hashes are
+    kept in an index in the album output directory so only new or changed sources are read again.
+    """
+
+    FILENAME = '.dedupe.json'
+
+    def __init__(self, output_dir, distance, max_pixels=None):
+        """
+        :param output_dir: album output directory, the index is stored here
+        :param distance: most bits the perceptual hashes of two images may differ by for them to be duplicates,
+                         0 to only find exact copies
+        :param max_pixels: largest number of pixels to decode an image at for its perceptual hash
+        """
+        self._file = Path(output_dir) / self.FILENAME
+        self._distance = distance
+        self._max_pixels = max_pixels
+        self._index = {}
+        if self._file.exists():
+            with self._file.open() as infile:
+                self._index = json.load(infile)
+
+    def _hashes(self, sources, executor):
+        """sha256 and perceptual hash of each source, from the index where it is unchanged
+        """
+        records = [self._index.get(str(source.path)) for source in sources]
+        stale = [source for source, record in zip(sources, records)
+                 if record is None or record['size'] != source.size or record['mtime'] != source.mtime]
+        args = ([source.path for source in stale], [source.file_type for source in stale],
+                [self._max_pixels] * len(stale))
+        results = map(content_hashes, *args) if executor is None else \
+            executor.map(content_hashes, *args, costs=[hash_cost(*source_args) for source_args in zip(*args)])
+        for source, (sha256, dhash) in zip(stale, results):
+            self._index[str(source.path)] = {'size': source.size, 'mtime': source.mtime, 'sha256': sha256,
+                                             'dhash': dhash}
+        # Only keep the sources still there
+        self._index = {str(source.path): self._index[str(source.path)] for source in sources}
+        return [self._index[str(source.path)] for source in sources]
+
+    def duplicates(self, sources, executor=None):
+        """Find the sources that duplicate an earlier one in the list
+
+        :param sources: list of SourceFile
+        :param executor: BudgetedExecutor to hash new sources in, or None to hash them in this process
+        :return: dictionary of the Path of each duplicate to (SourceFile it duplicates, True if an exact copy)
+        """
+        duplicates = {}
+        by_sha256 = {}
+        kept_images = []
+        for source, record in zip(sources, self._hashes(sources, executor)):
+            original = by_sha256.setdefault(record['sha256'], source)
+            if original is not source:
+                duplicates[source.path] = (original, True)
+                continue
+            if record['dhash'] is None:
+                continue
+            original = next((image for image, dhash in kept_images
+                             if bin(dhash ^ record['dhash']).count('1') <= self._distance), None)
+            if original is not None:
+                duplicates[source.path] = (original, False)
+            else:
+                kept_images.append((source, record['dhash']))
+        return duplicates
+
+    def sha256(self, source):
+        """sha256 of a source that duplicates has been called with, so it needn't be read again
+        """
+        return self._index[str(source.path)]['sha256']
+
+    def save(self):
+        with self._file.open('w') as outfile:
+            json.dump(self._index, outfile)
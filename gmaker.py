@@ -2,12 +2,15 @@ import tkinter as tk
 from tkinter import ttk
 from tkinter import filedialog
 from pathlib import Path
+import os
 import logging
 import webbrowser
-import paramiko
+import queue
+import threading
 
-from maker import AlbumMaker, _logger as maker_logger
+from maker import AlbumMaker, LINK_MODES, _logger as maker_logger
 from config import AlbumMakerConfig
+from progress import Cancelled, Progress
 
 _logger = logging.getLogger(__name__)
 
@@ -16,17 +19,15 @@ body_font = ("Times New Roman", 10)
 
 
 class GUILoggingHandler(logging.Handler):
-    """Put log messages into a Text widget
+    """Put log messages on a queue for the Tk loop to show, safe to use from worker threads
     """
 
-    def __init__(self, text_area, *args, **kwargs):
+    def __init__(self, log_queue, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.text_area = text_area
+        self.log_queue = log_queue
 
     def emit(self, record):
-        self.text_area.insert(tk.END, record.getMessage() + '\n')
-        self.text_area.see(tk.END)
-        self.text_area.update()
+        self.log_queue.put(record.getMessage())
 
 
 class ConfigDialog(tk.Toplevel):
@@ -80,6 +81,29 @@ class ConfigDialog(tk.Toplevel):
         ttk.Spinbox(self, textvariable=self.thumb_size_y, from_=200, to=1000, increment=5, width=8). \
             grid(column=1, row=row_number, sticky=tk.E)
 
+        # Number of processes
+        row_number += 2
+        self.jobs = tk.IntVar(value=self.album_config.jobs)
+        ttk.Label(self, text="Parallel jobs", font=body_font).grid(column=0, row=row_number, sticky=tk.W)
+        ttk.Spinbox(self, textvariable=self.jobs, from_=1, to=os.cpu_count() or 1).grid(column=1, row=row_number)
+
+        # Sub folders
+        row_number += 2
+        self.recursive = tk.IntVar(value=self.album_config.recursive)
+        ttk.Checkbutton(self, text="Include sub folders", variable=self.recursive). \
+            grid(column=0, row=row_number, sticky=tk.W, columnspan=2)
+        row_number += 1
+        self.sub_albums = tk.IntVar(value=self.album_config.sub_albums)
+        ttk.Checkbutton(self, text="Make sub folders into their own albums", variable=self.sub_albums). \
+            grid(column=0, row=row_number, sticky=tk.W, columnspan=2)
+
+        # How movies and docs are put in the album
+        row_number += 2
+        self.link_mode = tk.StringVar(value=self.album_config.link_mode)
+        ttk.Label(self, text="Movies and docs", font=body_font).grid(column=0, row=row_number, sticky=tk.W)
+        ttk.Combobox(self, textvariable=self.link_mode, values=LINK_MODES, state='readonly'). \
+            grid(column=1, row=row_number)
+
         # List of 'who'
         row_number += 2
         ttk.Label(self, text="Who (one per line)", font=body_font).grid(column=0, row=row_number, sticky=tk.W)
@@ -115,6 +139,19 @@ class ConfigDialog(tk.Toplevel):
         self.url = tk.StringVar(value=self.album_config.target_url)
         ttk.Entry(self, textvariable=self.url).grid(column=1, row=row_number, sticky=tk.W + tk.E, columnspan=2)
 
+        row_number += 2
+        self.upload_connections = tk.IntVar(value=self.album_config.upload_connections)
+        ttk.Label(self, text="Upload connections", font=body_font).grid(column=0, row=row_number, sticky=tk.W)
+        ttk.Spinbox(self, textvariable=self.upload_connections, from_=1, to=16).grid(column=1, row=row_number)
+        row_number += 2
+        self.delta_upload = tk.IntVar(value=self.album_config.delta_upload)
+        ttk.Checkbutton(self, text="Only upload changed files", variable=self.delta_upload). \
+            grid(column=0, row=row_number, sticky=tk.W, columnspan=2)
+        row_number += 1
+        self.delete_remote = tk.IntVar(value=self.album_config.delete_remote)
+        ttk.Checkbutton(self, text="Delete remote files no longer in the album", variable=self.delete_remote). \
+            grid(column=0, row=row_number, sticky=tk.W, columnspan=2)
+
         # Buttons
         row_number += 2
         self.cancel = ttk.Button(self, text='Cancel', command=self.destroy)
@@ -132,9 +169,14 @@ class ConfigDialog(tk.Toplevel):
         self.album_config.per_page = self.number_per_page.get()
         self.album_config.image_size = [self.image_size_x.get(), self.image_size_y.get()]
         self.album_config.thumbnail_size = [self.thumb_size_x.get(), self.thumb_size_y.get()]
+        self.album_config.jobs = self.jobs.get()
+        self.album_config.link_mode = self.link_mode.get()
+        self.album_config.recursive = bool(self.recursive.get())
+        self.album_config.sub_albums = bool(self.sub_albums.get())
 
         if self.server.get() and self.username.get():
             _logger.info('Checking remote details')
+            import paramiko
             with paramiko.Transport((self.server.get(), self.album_config.target_port)) as transport:
                 transport.connect(username=self.username.get(), password=self.password.get())
                 with paramiko.SFTPClient.from_transport(transport) as sftp:
@@ -145,6 +187,9 @@ class ConfigDialog(tk.Toplevel):
         self.album_config.target_username = self.username.get()
         self.album_config.target_password = self.password.get()
         self.album_config.target_url = self.url.get()
+        self.album_config.upload_connections = self.upload_connections.get()
+        self.album_config.delta_upload = bool(self.delta_upload.get())
+        self.album_config.delete_remote = bool(self.delete_remote.get())
         self.album_config.save()
         self.destroy()
 
@@ -153,18 +198,24 @@ class AlbumMakerGUI(tk.Frame):
     """
     """
 
+    POLL_MS = 100
+
     def __init__(self, master=None, config_file=None):
         super().__init__(master)
         self.master = master
         self.album_config = AlbumMakerConfig(config_file)
         self.who_values = self.album_config.who
+        self._log_queue = queue.Queue()
+        self._job_results = queue.Queue()
+        self._progress = None
         self.create_widgets()
         self.pack()
         log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
         maker_logger.setLevel(logging.INFO)
-        handler = GUILoggingHandler(self.output)
+        handler = GUILoggingHandler(self._log_queue)
         handler.setFormatter(log_formatter)
         maker_logger.addHandler(handler)
+        self.after(self.POLL_MS, self._poll)
 
     def create_widgets(self):
         self.title_frame = ttk.Label(self, text='Album Maker', font=big_font).grid(row=0, column=0, sticky='EW',
@@ -191,16 +242,27 @@ class AlbumMakerGUI(tk.Frame):
         self.output.config(yscrollcommand=ybar.set)
         ybar.grid(column=3, row=5, sticky="NS")
 
+        # Progress
+        self.progress_bar = ttk.Progressbar(self, mode='determinate')
+        self.progress_bar.grid(column=0, row=7, columnspan=3, sticky='EW')
+        self.progress_text = tk.StringVar()
+        ttk.Label(self, textvariable=self.progress_text, font=body_font).grid(column=0, row=8, columnspan=3,
+                                                                            sticky='W')
+
         # Options
         self.launch_browser = tk.IntVar(value=1)
         self.browser = ttk.Checkbutton(self, text="Launch browser on generate and upload", variable=self.launch_browser)
         self.browser.grid(column=0, row=9, sticky='W')
+        self.cancel = ttk.Button(self, text='Cancel', command=self.cancel_job, state='disabled')
+        self.cancel.grid(column=2, row=9, sticky='E')
 
         # Command buttons
         self.generate = ttk.Button(self, text='Generate', command=self.generate, state='disabled')
         self.generate.grid(column=0, row=10, sticky='W')
         self.upload = ttk.Button(self, text='Upload', command=self.upload, state='disabled')
         self.upload.grid(column=0, row=10, sticky='E')
+        self.publish = ttk.Button(self, text='Publish', command=self.publish, state='disabled')
+        self.publish.grid(column=1, row=10, sticky='W')
         self.config_btn = ttk.Button(self, text='Config', command=self.create_config_window)
         self.config_btn.grid(column=1, row=10, sticky='E')
         self.quit = ttk.Button(self, text='Quit', command=self.master.destroy)
@@ -220,55 +282,134 @@ class AlbumMakerGUI(tk.Frame):
             self.folder.set(folder_selected)
             if self.who_choice.current() is not None:
                 self.generate['state'] = 'normal'
+                self.publish['state'] = 'normal'
             else:
                 self.generate['state'] = 'disabled'
+                self.publish['state'] = 'disabled'
 
     def who_selected(self, event):
         self.output.delete(1.0, tk.END)
         if self.folder.get():
             self.generate['state'] = 'normal'
+            self.publish['state'] = 'normal'
         else:
             self.generate['state'] = 'disabled'
+            self.publish['state'] = 'disabled'
 
-    def generate(self):
-        self.output.insert(tk.END, '======== Generating\n')
+    def _start_job(self, title, job, on_success):
+        """Run a job on a worker thread so the window stays responsive
+
+        :param title: shown in the log
+        :param job: function taking the configured AlbumMaker, run on the worker
+        :param on_success: function taking the AlbumMaker and the job's result, run on the Tk thread
+        """
+        self.output.insert(tk.END, f'======== {title}\n')
+        self.output.see(tk.END)
+        self._button_states = {button: str(button['state'])
+                                for button in (self.generate, self.upload, self.publish, self.config_btn)}
+        for button in self._button_states:
+            button['state'] = 'disabled'
+        self.cancel['state'] = 'normal'
+        self.config(cursor="watch")
+        self._progress = Progress()
+        self._on_success = on_success
+        folder = self.folder.get()
+        who = self.who_values[self.who_choice.current()].lower()
+        progress = self._progress
+
+        def run():
+            try:
+                maker = AlbumMaker()
+                maker.configure(None, folder, None, who)
+                maker.progress = progress
+                self._job_results.put((maker, job(maker), None))
+            except Exception as e:
+                self._job_results.put((None, None, e))
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _finish_job(self, maker, result, error):
+        for button, state in self._button_states.items():
+            button['state'] = state
+        self.cancel['state'] = 'disabled'
+        self.config(cursor="")
+        self._show_progress()
+        self._progress = None
+        if isinstance(error, Cancelled):
+            self.output.insert(tk.END, '======== Cancelled\n')
+        elif error is not None:
+            self.output.insert(tk.END, '======== FAILED: ' + str(error) + '\n')
+        else:
+            self._on_success(maker, result)
         self.output.see(tk.END)
+
+    def _show_progress(self):
+        progress = self._progress
+        if progress.bytes_total:
+            self.progress_bar['maximum'] = progress.bytes_total
+            self.progress_bar['value'] = min(progress.bytes_done, progress.bytes_total)
+        else:
+            self.progress_bar['maximum'] = max(progress.files_total, 1)
+            self.progress_bar['value'] = progress.files_done
+        text = f"Files {progress.files_done}/{progress.files_total}" if progress.files_total else ''
+        if progress.bytes_total:
+            text += f"  Uploaded {progress.bytes_done / 1e6:.1f}/{progress.bytes_total / 1e6:.1f} MB"
+        self.progress_text.set(text)
+
+    def _poll(self):
+        """Show queued log messages in one go and update the progress, every POLL_MS on the Tk thread
+        """
         try:
-            self.config(cursor="wait")
-            self.update()
-            maker = AlbumMaker()
-            maker.configure(None, self.folder.get(), None, self.who_values[self.who_choice.current()].lower())
-            maker.generate()
+            finished = self._job_results.get_nowait()
+        except queue.Empty:
+            finished = None
+        lines = []
+        while True:
+            try:
+                lines.append(self._log_queue.get_nowait())
+            except queue.Empty:
+                break
+        if lines:
+            self.output.insert(tk.END, '\n'.join(lines) + '\n')
+            self.output.see(tk.END)
+        if self._progress is not None:
+            self._show_progress()
+        if finished is not None:
+            self._finish_job(*finished)
+        self.after(self.POLL_MS, self._poll)
+
+    def cancel_job(self):
+        if self._progress is not None:
+            self.output.insert(tk.END, '======== Cancelling after the current file\n')
+            self._progress.cancel()
+            self.cancel['state'] = 'disabled'
+
+    def generate(self):
+        def done(maker, result):
             if self.launch_browser.get():
                 url = maker.output_dir / Path('index.html')
                 webbrowser.open(url, new=2)
             self.output.insert(tk.END, '======== Done generating\n')
             self.upload['state'] = 'normal'
-        except Exception as e:
-            self.output.insert(tk.END, '======== FAILED: ' + str(e) + '\n')
-        finally:
-            self.config(cursor="")
-            self.update()
-            self.output.see(tk.END)
+
+        self._start_job('Generating', lambda maker: maker.generate(), done)
 
     def upload(self):
-        self.output.insert(tk.END, '======== Uploading\n')
-        self.output.see(tk.END)
-        try:
-            self.config(cursor="wait")
-            self.update()
-            maker = AlbumMaker()
-            maker.configure(None, self.folder.get(), None, self.who_values[self.who_choice.current()].lower())
-            url = maker.upload()
+        def done(maker, url):
             self.output.insert(tk.END, '======== Done upload\n')
             if self.launch_browser.get():
                 webbrowser.open(url, new=2)
-        except Exception as e:
-            self.output.insert(tk.END, '======== FAILED: ' + str(e) + '\n')
-        finally:
-            self.config(cursor="")
-            self.update()
-            self.output.see(tk.END)
+
+        self._start_job('Uploading', lambda maker: maker.upload(), done)
+
+    def publish(self):
+        def done(maker, url):
+            self.output.insert(tk.END, '======== Done publish\n')
+            self.upload['state'] = 'normal'
+            if self.launch_browser.get():
+                webbrowser.open(url, new=2)
+
+        self._start_job('Publishing', lambda maker: maker.publish(), done)
 
 
 if __name__ == '__main__':
@@ -1,91 +1,713 @@
 from pathlib import Path
 from argparse import ArgumentParser
+import json
 import logging
-from jinja2 import FileSystemLoader, Environment
+import os
 import shutil
-from PIL import Image, ImageOps
-import paramiko
+import subprocess
+import tempfile
+import time
+from contextlib import nullcontext
+from functools import lru_cache
+from importlib.util import find_spec
+from io import BytesIO
+from itertools import repeat
+import yaml
 
 from config import AlbumMakerConfig
+from profiler import Profiler, Timings
+from progress import Cancelled, Progress
+from cache import DerivativeCache
+from compress import COMPRESSIBLE, compressed_copies, minify_html, precompress, precompressed, remove_compressed
+from manifest import BuildManifest, file_hash
+from scanner import scan, sub_directories, suffix_types
 
 _logger = logging.getLogger('maker')
 
 
+def _fits_within(size, box):
+    """True if size is no bigger than box in either dimension
+    """
+    return size[0] <= box[0] and size[1] <= box[1]
+
+
+ORIENTATION = 0x0112
+
+
+def _open_image(file):
+    """Open an image with Pillow, imported when first needed as uploading doesn't use it
+    """
+    from PIL import Image
+    # Images are checked against max_image_pixels at the size they are decoded at instead, see decode_size
+    Image.MAX_IMAGE_PIXELS = None
+    return Image.open(file)
+
+
+def _fit(size, box):
+    """Size of an image scaled down to fit within box as Image.thumbnail does
+    """
+    ratio = min(box[0] / size[0], box[1] / size[1], 1)
+    return max(1, round(size[0] * ratio)), max(1, round(size[1] * ratio))
+
+
+def needed_size(size, orientation, image_size, thumbnail_size, scales):
+    """Smallest size an image needs decoding at to make its largest output as well as Image.thumbnail
+    would, which keeps twice the output size, in the orientation the image is stored in.
+    Panoramas only need their long side decoding at twice the output.
+
+    :param size: size of the stored image
+    :param orientation: EXIF orientation, 5 to 8 are turned by 90 degrees
+    """
+    boxes = [(image_size[0] * max([1, *scales]), image_size[1] * max([1, *scales])), thumbnail_size]
+    if orientation in (5, 6, 7, 8):
+        boxes = [(box[1], box[0]) for box in boxes]
+    fits = [_fit(size, box) for box in boxes]
+    return min(size[0], 2 * max(fit[0] for fit in fits)), min(size[1], 2 * max(fit[1] for fit in fits))
+
+
+def decode_size(size, image_format, needed):
+    """Size an image is decoded at when draft asks for needed. JPEGs are scaled down by 1/2, 1/4 or 1/8
+    while decoding, others are decoded at full size.
+    """
+    if image_format not in ('JPEG', 'MPO'):
+        return size
+    limit = min(size[0] // needed[0], size[1] // needed[1])
+    scale = max(scale for scale in (1, 2, 4, 8) if scale <= max(1, limit))
+    return -(-size[0] // scale), -(-size[1] // scale)
+
+
+def memory_cost(file, image_size, thumbnail_size, scales):
+    """Estimate of the memory making the derivatives of an image takes, reading only its header
+
+    :return: bytes, the decoded image and one copy of it at 4 bytes a pixel
+    """
+    with _open_image(file) as im:
+        orientation = im.getexif().get(ORIENTATION, 1)
+        width, height = decode_size(im.size, im.format, needed_size(im.size, orientation, image_size,
+                                                                    thumbnail_size, scales))
+    return width * height * 4 * 2
+
+
+LINK_MODES = ['copy', 'hardlink', 'reflink', 'symlink', 'reference']
+FICLONE = 0x40049409
+
+
+def _reflink(file, target):
+    """Clone a file sharing its blocks where the filesystem supports it (btrfs, XFS), otherwise let the
+    kernel copy it with copy_file_range
+    """
+    with open(file, 'rb') as infile, open(target, 'wb') as outfile:
+        try:
+            import fcntl
+            fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+            return
+        except (ImportError, OSError):
+            pass
+        remaining = os.fstat(infile.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(infile.fileno(), outfile.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+
+
+def materialise(file, name, target_dir, link_mode):
+    """Put a movie or doc into the output directory using link_mode, falling back to a copy when the
+    filesystem can't do it. With 'reference' nothing is put there and the source is uploaded instead.
+
+    :param name: filename in target_dir
+    :return: True if the file is now in target_dir
+    """
+    if link_mode == 'reference':
+        return False
+    target = Path(target_dir) / name
+    # A link from an earlier build would make a copy write through it, or fail as the same file
+    target.unlink(missing_ok=True)
+    if link_mode != 'copy':
+        try:
+            if link_mode == 'hardlink':
+                os.link(file, target)
+            elif link_mode == 'symlink':
+                os.symlink(file.resolve(), target)
+            elif link_mode == 'reflink':
+                _reflink(file, target)
+            shutil.copystat(file, target)
+            return True
+        except (AttributeError, OSError) as e:
+            _logger.warning(f"Could not {link_mode} {file.name} ({e}), copying")
+    shutil.copy2(file, target)
+    return True
+
+
+ENCODER_OPTIONS = {
+    'JPEG': {'quality': 80, 'optimize': True, 'progressive': True},
+    'WEBP': {'quality': 78, 'method': 6},
+    'AVIF': {'quality': 55, 'speed': 6},
+}
+FORMAT_SUFFIXES = {'JPEG': '.jpg', 'WEBP': '.webp', 'AVIF': '.avif'}
+# Lowest quality a target size can take each encoder down to
+MIN_QUALITY = {'JPEG': 40, 'WEBP': 40, 'AVIF': 25}
+# Leave out the EXIF, comments, XMP and colour profile of the source, the images are already the right way up and
+# converted to OUTPUT_PROFILE, which browsers assume for images without a profile
+OUTPUT_PROFILE = 'sRGB'
+STRIP_METADATA = {'exif': b'', 'comment': b'', 'xmp': b'', 'icc_profile': None}
+# Entries of an album for the viewer page when page_mode is json
+ALBUM_JSON = 'album.json'
+
+
+@lru_cache
+def output_formats(formats):
+    """The formats from a tuple that the installed Pillow can write, upper case as Pillow names them
+    """
+    from PIL import features
+    usable = []
+    for image_format in formats:
+        image_format = image_format.upper()
+        if image_format == 'JPEG' or features.check(image_format.lower()):
+            usable.append(image_format)
+        else:
+            _logger.warning(f"This Pillow can't write {image_format}, leaving it out")
+    return usable
+
+
+def encoder_options(image_format, quality=None):
+    """Options for saving in a format, with the quality from the config if set
+
+    :param quality: dictionary of lower case format to quality
+    """
+    options = dict(ENCODER_OPTIONS.get(image_format, {}))
+    if quality and image_format.lower() in quality:
+        options['quality'] = quality[image_format.lower()]
+    return options
+
+
+def _renditions(im, image_size, scales):
+    """Resize an image to fit image_size multiplied by each scale, skipping sizes the image is too small
+    to make different from a larger one. Scale 1 is always included.
+
+    :return: list of (scale, image), largest first
+    """
+    renditions = []
+    for scale in sorted(set(scales) | {1}, reverse=True):
+        resized = (renditions[-1][1] if renditions else im).copy()
+        resized.thumbnail((round(image_size[0] * scale), round(image_size[1] * scale)))
+        if renditions and renditions[-1][1].size == resized.size:
+            if scale == 1:
+                renditions[-1] = (scale, renditions[-1][1])
+            continue
+        renditions.append((scale, resized))
+    return renditions
+
+
+def _to_output_profile(im, name):
+    """Convert an image with an embedded colour profile to OUTPUT_PROFILE, so leaving the profile out
+    doesn't change its colours. Images the conversion fails for are left as they are.
+
+    :param name: filename of the image for the log
+    """
+    from PIL import features
+    icc_profile = im.info.get('icc_profile')
+    if not icc_profile or im.mode not in ('RGB', 'RGBA', 'CMYK', 'L') or not features.check('littlecms2'):
+        return im
+    from PIL import ImageCms
+    try:
+        profile = ImageCms.ImageCmsProfile(BytesIO(icc_profile))
+        if ImageCms.getProfileDescription(profile).strip().startswith(OUTPUT_PROFILE):
+            return im
+        return ImageCms.profileToProfile(im, profile, ImageCms.createProfile(OUTPUT_PROFILE),
+                                         outputMode='RGBA' if im.mode == 'RGBA' else 'RGB')
+    except (OSError, ImageCms.PyCMSError) as e:
+        _logger.warning(f"Can't convert the colour profile of {name}, leaving it as it is: {e}")
+        return im
+
+
+def encode(im, image_format, options, target=0):
+    """Encode an image in memory without its metadata. With a target size the quality is bisected between
+    MIN_QUALITY and the quality in options for the highest that fits, using the lowest if none does.
+
+    :param options: encoder options, see encoder_options
+    :param target: most bytes the image should take, 0 for no target
+    :return: (encoded bytes, quality used or None if the format has no quality)
+    """
+    def at(quality):
+        buffer = BytesIO()
+        im.save(buffer, format=image_format, **{**options, **STRIP_METADATA, 'quality': quality})
+        return buffer.getvalue()
+
+    high = options.get('quality')
+    data = at(high)
+    if not target or high is None or image_format not in MIN_QUALITY or len(data) <= target:
+        return data, high
+    low = min(MIN_QUALITY[image_format], high)
+    best = None
+    attempt = data
+    while low < high:
+        middle = (low + high) // 2
+        attempt = at(middle)
+        if len(attempt) <= target:
+            best = (attempt, middle)
+            low = middle + 1
+        else:
+            high = middle
+    # When nothing fits the last attempt was at the lowest quality
+    return best or (attempt, low)
+
+
+def _save(im, output_dir, output, image_format, quality, target, timings):
+    """Save an image in a format, replacing rather than writing through any existing file as
+    it may be a hard link to the cache
+
+    :param target: most bytes the image should take, 0 for no target
+    """
+    start = time.perf_counter()
+    target_file = Path(output_dir) / output
+    target_file.unlink(missing_ok=True)
+    if image_format in FORMAT_SUFFIXES and im.mode not in ('RGB', 'RGBA'):
+        im = im.convert('RGBA' if image_format != 'JPEG' and im.mode in ('LA', 'PA', 'P') else 'RGB')
+    data, used = encode(im, image_format, encoder_options(image_format, quality), target)
+    target_file.write_bytes(data)
+    timings.add(f'encode {image_format}', time.perf_counter() - start, written=len(data))
+    # Formats without a quality, like PNG, can't be made to fit a target
+    timings.encoded[str(target_file)] = {'bytes': len(data), 'quality': used, 'target': target if used else 0}
+
+
+def image_outputs(name, sizes):
+    """Paths of the resized images and thumbnails of an image relative to the album output directory
+
+    :param name: filename of the image in the album
+    :param sizes: dimensions and renditions returned by make_derivatives
+    """
+    return [*(f'images/{name}{extra}' for rendition in sizes['renditions'] for extra, _ in rendition['images']),
+            *(f'thumbs/{name}{rendition["thumb"]}' for rendition in sizes['renditions'])]
+
+
+def _make_images(file, size, name, output_dir, image_size, thumbnail_size, formats, scales, quality, target_kb,
+                 max_pixels, timings):
+    """Make the resized images and thumbnail of an image. images/name and thumbs/name are in the
+    format of the source, with extra renditions at the other scales and in the other formats.
+
+    :param size: size of the file in bytes from the scan
+    :param target_kb: (image, thumbnail) size to encode to in KB, 0 for no target, see encode
+    :param max_pixels: largest number of pixels to decode, bigger images raise ValueError
+    :return: dictionary of dimensions and renditions for the entry, see image_outputs
+    """
+    from PIL import ImageOps
+    with _open_image(file) as im:
+        with timings.stage('decode', read=size):
+            base_format = 'JPEG' if im.format == 'MPO' else im.format
+            needed = needed_size(im.size, im.getexif().get(ORIENTATION, 1), image_size, thumbnail_size, scales)
+            decoded = decode_size(im.size, im.format, needed)
+            if max_pixels and decoded[0] * decoded[1] > max_pixels:
+                raise ValueError(f"{Path(file).name} needs {decoded[0] * decoded[1] / 1e6:.0f} megapixels decoding, "
+                                 f"more than max_image_pixels")
+            # Let the JPEG decoder scale down while decoding
+            im.draft(None, needed)
+            im.load()
+            # Other formats are decoded at full size, shrink them before turning them round
+            factor = min(im.width // needed[0], im.height // needed[1])
+            if factor >= 2:
+                im = im.reduce(factor)
+        with timings.stage('exif_transpose'):
+            im = ImageOps.exif_transpose(im)
+        with timings.stage('colour profile'):
+            im = _to_output_profile(im, name)
+        return _write_images(im, name, output_dir, base_format, image_size, thumbnail_size, formats, scales, quality,
+                             target_kb, timings)
+
+
+def _write_images(im, name, output_dir, base_format, image_size, thumbnail_size, formats, scales, quality, target_kb,
+                  timings):
+    """Resize a decoded image the right way up and save the images and thumbnail, see _make_images
+
+    :param base_format: format of images/name and thumbs/name
+    :return: dictionary of dimensions and renditions for the entry
+    """
+    from PIL import Image
+    with timings.stage('resize'):
+        # Derive the thumbnail from the resized image unless the thumbnail is the larger of the two
+        thumb_from_resized = _fits_within(thumbnail_size, image_size)
+        if not thumb_from_resized:
+            thumb = im.copy()
+            thumb.thumbnail(thumbnail_size)
+        renditions = _renditions(im, image_size, scales)
+        image = next(resized for scale, resized in renditions if scale == 1)
+        if thumb_from_resized:
+            thumb = image.copy()
+            thumb.thumbnail(thumbnail_size)
+
+    image_kb, thumbnail_kb = target_kb or (0, 0)
+    sizes = {'image_width': image.width, 'image_height': image.height,
+             'thumb_width': thumb.width, 'thumb_height': thumb.height, 'renditions': []}
+    # Load all the format plugins so their types are in Image.MIME
+    Image.init()
+    # The format of the source last, as the fallback for browsers that don't support the others
+    for image_format in [*(f for f in formats if f != base_format), base_format]:
+        suffix = Path(name).suffix if image_format == base_format else FORMAT_SUFFIXES[image_format]
+        rendition = {'type': Image.MIME.get(image_format), 'images': [],
+                     'thumb': '' if image_format == base_format else suffix}
+        for scale, resized in reversed(renditions):
+            extra = '' if scale == 1 and image_format == base_format else f'.{resized.width}{suffix}'
+            # The other scales get a share of the target by area
+            target = round(image_kb * 1000 * resized.width * resized.height / (image.width * image.height))
+            _save(resized, output_dir, f'images/{name}{extra}', image_format, quality, target, timings)
+            rendition['images'].append([extra, resized.width])
+        _save(thumb, output_dir, f'thumbs/{name}{rendition["thumb"]}', image_format, quality, thumbnail_kb * 1000,
+              timings)
+        sizes['renditions'].append(rendition)
+    return sizes
+
+
+@lru_cache
+def preview_tools():
+    """Tools installed for making a preview image of each type of file that isn't an image
+
+    :return: dictionary of file type to the name of the tool, None if there is none
+    """
+    doc_tool = 'pymupdf' if find_spec('fitz') else 'pdftoppm' if shutil.which('pdftoppm') else None
+    return {'movie': 'ffmpeg' if shutil.which('ffmpeg') else None, 'doc': doc_tool}
+
+
+def _poster_frame(file):
+    """Frame a second into a movie, or the first frame of a shorter one, using ffmpeg
+
+    :return: PIL Image or None if ffmpeg can't read the movie
+    """
+    from PIL import Image
+    for position in ('1', '0'):
+        result = subprocess.run(['ffmpeg', '-v', 'error', '-ss', position, '-i', str(file), '-frames:v', '1',
+                                 '-f', 'image2pipe', '-c:v', 'png', '-'], capture_output=True)
+        if result.returncode == 0 and result.stdout:
+            return Image.open(BytesIO(result.stdout))
+    _logger.warning(f"No poster frame for {Path(file).name}: {result.stderr.decode(errors='replace').strip()}")
+    return None
+
+
+def _first_page(file, tool, longest):
+    """First page of a PDF, rendered with PyMuPDF or pdftoppm
+
+    :param longest: size in pixels of the longest side
+    :return: PIL Image or None if the PDF can't be read
+    """
+    from PIL import Image
+    try:
+        if tool == 'pymupdf':
+            import fitz
+            with fitz.open(file) as document:
+                page = document[0]
+                zoom = longest / max(page.rect.width, page.rect.height)
+                pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+                return Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            subprocess.run(['pdftoppm', '-f', '1', '-l', '1', '-singlefile', '-png', '-scale-to', str(longest),
+                            str(file), f'{tmp_dir}/page'], capture_output=True, check=True)
+            with Image.open(f'{tmp_dir}/page.png') as im:
+                return im.convert('RGB')
+    except Exception as e:
+        _logger.warning(f"No preview for {Path(file).name}: {e}")
+        return None
+
+
+def _make_preview(file, size, file_type, name, output_dir, image_size, thumbnail_size, formats, scales, quality,
+                  target_kb, tool, timings):
+    """Make images and a thumbnail as for an image from a poster frame of a movie or the first page of a PDF
+
+    :param size: size of the file in bytes from the scan
+    :param name: filename for the outputs, ending .jpg
+    :param tool: from preview_tools
+    :return: dictionary of dimensions and renditions as _make_images, or None if there is no preview
+    """
+    with timings.stage(f'preview {file_type}', read=size):
+        if file_type == 'movie':
+            im = _poster_frame(file)
+        elif Path(file).suffix.lower() == '.pdf':
+            im = _first_page(file, tool, round(max(image_size) * max([1, *scales])))
+        else:
+            im = None
+    if im is None:
+        return None
+    return _write_images(im, name, output_dir, 'JPEG', image_size, thumbnail_size, formats, scales, quality, target_kb,
+                         timings)
+
+
+def make_derivatives(file, name, file_type, size, output_dir, image_size, thumbnail_size, link_mode='copy',
+                     cache_dir=None, formats=(), scales=(1,), quality=None, max_pixels=None, previews=None,
+                     target_kb=None, content_hash=None):
+    """Make the resized images and thumbnail for an image, copy or link movies and docs as they are and make
+    images from a poster frame or first page of them when the tool for it is installed. Module level so it
+    can be run in a worker process.
+
+    :param name: filename for the outputs
+    :param size: size of the file in bytes from the scan, so it isn't looked up again
+    :param output_dir: album output directory, with images and thumbs directories
+    :param cache_dir: directory of the DerivativeCache to take images from and add them to, or None
+    :param formats: formats to make as well as the format of the source, see output_formats
+    :param scales: sizes to make relative to image_size
+    :param quality: dictionary of lower case format to quality to override ENCODER_OPTIONS
+    :param max_pixels: largest number of pixels to decode an image at, bigger images raise ValueError
+    :param previews: from preview_tools, None or empty to make no previews
+    :param target_kb: (image, thumbnail) size to encode to in KB, None or 0 for no target
+    :param content_hash: sha256 of the file if already known, otherwise it is read to work it out
+    :return: dictionary of dimensions to add to the entry, the outputs made relative to output_dir,
+             the hash of the file and the Timings of making them. The images of a movie or doc are named
+             as in the preview entry. An image too big to decode has no dimensions.
+    """
+    timings = Timings()
+    if content_hash is None:
+        with timings.stage('hash', read=size):
+            content_hash = file_hash(file)
+    outputs = []
+    tool = None
+    if file_type != 'image':
+        with timings.stage(f'{link_mode} {file_type}'):
+            if materialise(file, name, Path(output_dir) / 'images', link_mode):
+                outputs.append(f'images/{name}')
+        tool = (previews or {}).get(file_type)
+        if tool is None:
+            return {}, outputs, content_hash, timings
+        # Named after the file with .jpg added so the images don't clash with it
+        name = f'{name}.jpg'
+    cache = DerivativeCache(cache_dir) if cache_dir else None
+    if cache is not None:
+        # The orientation is part of the content so the hash covers it
+        key = cache.key(content_hash, {'image_size': image_size, 'thumbnail_size': thumbnail_size,
+                                       'suffix': Path(name).suffix, 'formats': list(formats), 'scales': list(scales),
+                                       'encoder': {f: encoder_options(f, quality) for f in ['JPEG', *formats]},
+                                       'preview': tool, 'target_kb': list(target_kb or []),
+                                       'profile': OUTPUT_PROFILE})
+        with timings.stage('cache fetch'):
+            sizes = cache.fetch(key, output_dir, lambda sizes: image_outputs(name, sizes))
+    if cache is None or sizes is None:
+        if file_type == 'image':
+            try:
+                sizes = _make_images(file, size, name, output_dir, image_size, thumbnail_size, formats, scales,
+                                     quality, target_kb, max_pixels, timings)
+            except ValueError as e:
+                # The rest of the album is still made, this image is linked to as it is like a doc
+                _logger.warning(f"{e}, linking to it as it is")
+                with timings.stage(f'{link_mode} {file_type}'):
+                    if materialise(file, name, Path(output_dir) / 'images', link_mode):
+                        outputs.append(f'images/{name}')
+                return {}, outputs, content_hash, timings
+        else:
+            sizes = _make_preview(file, size, file_type, name, output_dir, image_size, thumbnail_size, formats,
+                                  scales, quality, target_kb, tool, timings)
+            if sizes is None:
+                return {}, outputs, content_hash, timings
+        if cache is not None:
+            with timings.stage('cache store'):
+                cache.store(key, output_dir, sizes, image_outputs(name, sizes))
+    if file_type != 'image':
+        sizes = {**sizes, 'preview': name}
+    return sizes, outputs + image_outputs(name, sizes), content_hash, timings
+
+
+def _entry_type(file_type, sizes):
+    """Type to show a file as, doc for an image that was too big to make images of
+    """
+    return 'doc' if file_type == 'image' and 'renditions' not in sizes else file_type
+
+
+_environments = {}
+
+
+def template_environment(template_dir):
+    """Jinja Environment for a directory of templates, made once so the compiled templates are reused
+    """
+    environment = _environments.get(template_dir)
+    if environment is None:
+        from jinja2 import Environment, FileSystemLoader
+        environment = _environments[template_dir] = Environment(loader=FileSystemLoader(template_dir))
+    return environment
+
+
 class AlbumMaker:
     """Create an album of school work and upload via SFTP
     """
 
-    def configure(self, config_file, input_dir, title, who):
+    def configure(self, config_file, input_dir, title, who, jobs=None):
         """
         :param config_file: Yaml file with settings, if None will look for config.yml in this directory
         :param input_dir: Directory with input files
         :param title: If none will default to directory name of input
         :param who:
+        :param jobs: Number of processes for making images, if None use the value from the config
         """
         self.who = who
         self._config = AlbumMakerConfig(config_file)
+        self.jobs = jobs if jobs is not None else self._config.jobs
+        self.on_output = None
+        self.progress = Progress()
+        self.profiler = Profiler()
+        self.parent = None
+        self.depth = 0
+        # Filled in by scan_input_dir
+        self.sub_albums = None
 
         self.input_dir = Path(input_dir)
         self.album_dirname = self.input_dir.name.lower().replace(' ', '')
-        self.output_dir = Path(self._config.local_dir) / Path(self.who) / Path(self.album_dirname)
-        self.output_dir.mkdir(exist_ok=True, parents=True)
-        self.image_dir = self.output_dir / Path('images')
-        self.image_dir.mkdir(exist_ok=True)
-        self.thumb_dir = self.output_dir / Path('thumbs')
-        self.thumb_dir.mkdir(exist_ok=True)
+        self._make_output_dirs(Path(self._config.local_dir) / Path(self.who) / Path(self.album_dirname))
 
-        if title is None:
-            self.title = self.input_dir.name
+        self.title = self.input_dir.name if title is None else title
 
         self.template_dir = Path(__file__).parents[0] / Path('styles') / Path(self._config.style)
-        self.environ = Environment(loader=FileSystemLoader(self.template_dir))
         _logger.info(f"Workdir is {self.output_dir}")
         _logger.info(f"Input dir is {self.input_dir}")
         _logger.info(f"Title is {self.title}")
         return self
 
+    @property
+    def environ(self):
+        """Jinja Environment for the style, shared by every album using it
+        """
+        return template_environment(self.template_dir)
+
+    def _formats(self):
+        """Image formats to make that this Pillow supports
+        """
+        return list(output_formats(tuple(self._config.image_formats)))
+
+    def _previews(self):
+        """Tools to make previews of movies and docs with, empty if they are turned off
+        """
+        return preview_tools() if self._config.previews else {}
+
+    def _target_kb(self):
+        """Sizes in KB to encode images and thumbnails to, as a list so it compares with the saved manifest
+        """
+        return [self._config.image_kb or 0, self._config.thumbnail_kb or 0]
+
+    def _make_output_dirs(self, output_dir):
+        self.output_dir = output_dir
+        self.output_dir.mkdir(exist_ok=True, parents=True)
+        self.image_dir = self.output_dir / Path('images')
+        self.image_dir.mkdir(exist_ok=True)
+        self.thumb_dir = self.output_dir / Path('thumbs')
+        self.thumb_dir.mkdir(exist_ok=True)
+
+    def _sub_album(self, input_dir):
+        """AlbumMaker for a sub folder, made in a directory of the same name inside this album
+        """
+        album = AlbumMaker()
+        album.who = self.who
+        album._config = self._config
+        album.jobs = self.jobs
+        album.on_output = None
+        album.progress = self.progress
+        album.profiler = self.profiler
+        album.parent = self
+        album.depth = self.depth + 1
+        album.input_dir = input_dir
+        album.album_dirname = input_dir.name.lower().replace(' ', '')
+        if album.album_dirname in ('images', 'thumbs', 'resources'):
+            album.album_dirname += '_album'
+        album._make_output_dirs(self.output_dir / album.album_dirname)
+        album.title = input_dir.name
+        album.template_dir = self.template_dir
+        return album
+
     def scan_input_dir(self):
-        """Scan input dir for files
+        """Scan input dir for files, and sub folders for sub albums when enabled
         """
         self.files = []
-        for file in sorted(self.input_dir.glob('*')):
-            file_suffix = file.suffix.lower()
-            if file_suffix in self._config.image_suffix:
-                _logger.info(f"Adding {file}")
-                self.files.append((file, 'image'))
-            elif file_suffix in self._config.movie_suffix:
-                _logger.info(f"Adding {file}")
-                self.files.append((file, 'movie'))
-            elif file_suffix in self._config.doc_suffix:
-                _logger.info(f"Adding {file}")
-                self.files.append((file, 'doc'))
-
-    def make_image(self, file, entry, workdir):
-        """Make page for an image
+        self.sub_albums = []
+        self._derived = None
+        self._duplicates = []
+        # sha256 of each source from finding duplicates, so making derivatives needn't read it again
+        self._content_hashes = {}
+        sub_albums = self._config.sub_albums
+        with self.profiler.stage('scan'):
+            for source in scan(self.input_dir, suffix_types(self._config), self._config.recursive and not sub_albums):
+                _logger.info(f"Adding {source.path}")
+                self.files.append(source)
+        if sub_albums:
+            for input_dir in sub_directories(self.input_dir):
+                album = self._sub_album(input_dir)
+                album.scan_input_dir()
+                if album.files or album.sub_albums:
+                    _logger.info(f"Adding sub album {input_dir}")
+                    self.sub_albums.append(album)
+
+    def _find_duplicates(self, executor=None):
+        """Find files that are copies of another in the album, or look the same, and with dedupe set to
+        collapse leave them out of it
+        """
+        from dedupe import DuplicateFinder
+        finder = DuplicateFinder(self.output_dir, self._config.dedupe_distance, self._config.max_image_pixels)
+        with self.profiler.stage('find duplicates'):
+            duplicates = finder.duplicates(self.files, executor)
+        finder.save()
+        self._content_hashes = {source.path: finder.sha256(source) for source in self.files}
+        self._duplicates = [(source, *duplicates[source.path]) for source in self.files if source.path in duplicates]
+        for source, original, exact in self._duplicates:
+            _logger.info(f"{source.name} {'is a copy of' if exact else 'looks like'} {original.name}")
+        if self._config.dedupe == 'collapse':
+            self.files = [source for source in self.files if source.path not in duplicates]
+
+    def _report_duplicates(self):
+        """Log how much making and uploading the duplicates costs, or saved when they are left out
+        """
+        source_size = sum(source.size for source, _, _ in self._duplicates)
+        upload_size = sum(self._manifest.output_size(original) for _, original, _ in self._duplicates)
+        saving = 'Left out' if self._config.dedupe == 'collapse' else 'Could leave out'
+        _logger.info(f"{saving} {len(self._duplicates)} duplicates in {self.title}, {source_size / 1e6:.1f} MB of "
+                     f"files not to process and about {upload_size / 1e6:.1f} MB not to upload")
+
+    def _all_albums(self):
+        """This album and all its sub albums, sub albums before the album they are in
+        """
+        for album in self.sub_albums:
+            yield from album._all_albums()
+        yield self
+
+    def _output_written(self, output, subdir, name=None):
+        """Pass a finished derivative or image page to the on_output callback, used to upload while generating
+
+        :param output: Path of the file
+        :param subdir: directory it belongs in relative to the album
+        :param name: filename in the album if not the same as output's
+        """
+        if self.parent is not None:
+            self.parent._output_written(output, f'{self.album_dirname}/{subdir}', name or output.name)
+        elif self.on_output is not None:
+            self.on_output(output, subdir, name or output.name)
+
+    def make_image(self, source, entry, workdir):
+        """Make page for an image, the derivatives must already have been made
+
+        :param source: SourceFile the page is for
         """
         template = self.environ.get_template('image.tmpl')
         output = Path(workdir) / Path('images') / Path(entry["html_file"])
-        if entry['type'] == 'image':
-            with Image.open(file) as im:
-                im = ImageOps.exif_transpose(im)
-                im.thumbnail(self._config.thumbnail_size)
-                thumbfile = self.thumb_dir / Path(file.name)
-                im.save(thumbfile)
-                entry['thumb_width'] = im.width
-                entry['thumb_height'] = im.height
-            with Image.open(file) as im:
-                im = ImageOps.exif_transpose(im)
-                im.thumbnail(self._config.image_size)
-                resized_file = self.image_dir / Path(file.name)
-                im.save(resized_file)
-                entry['image_width'] = im.width
-                entry['image_height'] = im.height
-        else:
+        # Movies and docs with a preview have images named after it
+        image_name = entry.get('preview', source.name)
+        if entry['type'] != 'image' and 'preview' not in entry:
             entry['image_height'] = self._config.image_size[1]
-        entry['image_file'] = file.name
-        with output.open('w') as outfile:
-            template.stream(entry=entry, title=self.title).dump(outfile)
-        entry['thumb'] = f"thumbs/{file.name}"
+        entry['image_file'] = source.name
+        if 'renditions' in entry:
+            sources = [{'type': rendition['type'],
+                        'srcset': ', '.join(f'{image_name}{extra} {width}w' for extra, width in rendition['images']),
+                        'thumb': f'thumbs/{image_name}{rendition["thumb"]}'} for rendition in entry['renditions']]
+            entry['image_srcset'] = sources[-1]['srcset']
+            entry['image_sources'] = sources[:-1]
+        with self.profiler.stage('render page'):
+            content = template.render(entry=entry, title=self.title, root=self._root())
+        if self._write(output, content):
+            for copy in compressed_copies(output):
+                self._output_written(copy, 'images')
+            self._output_written(output, 'images')
+        entry['thumb'] = f"thumbs/{image_name}"
+
+    def _root(self):
+        """Relative path from this album to the top album, where the resources are
+        """
+        return '../' * self.depth
+
+    def _album_links(self):
+        """Title, link and cover thumbnail of each sub album for the index page
+        """
+        return [{'title': album.title, 'link': f'{album.album_dirname}/index.html',
+                 'cover': f'{album.album_dirname}/{album.cover}' if album.cover else None}
+                for album in self.sub_albums]
 
     def _write_page(self, workdir, entries, page_number, is_last_page):
         """
@@ -108,37 +730,193 @@ class AlbumMaker:
             prev_page = 'index.html' if page_number == 1 else f"page{page_number - 1}.html"
             filename = f'page{page_number}.html'
         output = Path(workdir) / Path(filename)
-        with output.open('w') as outfile:
-            template.stream(entries=entries, title=self.title, prev_page=prev_page, next_page=next_page,
-                            thumb_x=self._config.thumbnail_size[0],
-                            thumb_y=self._config.thumbnail_size[1],
-                            who=self.who.capitalize()).dump(outfile)
+        with self.profiler.stage('render page'):
+            content = template.render(entries=entries, title=self.title, prev_page=prev_page, next_page=next_page,
+                                      thumb_x=self._config.thumbnail_size[0], thumb_y=self._config.thumbnail_size[1],
+                                      who=self.who.capitalize(), root=self._root(),
+                                      albums=self._album_links() if page_number == 0 else [],
+                                      parent_page='../index.html' if self.parent else None)
+        self._write(output, content)
         return filename
 
+    def _json_entry(self, source, entry):
+        """Compact entry for album.json, paths relative to the album
+
+        :param entry: entry as make_image takes it
+        """
+        item = {'type': entry['type'], 'name': entry['link_text'], 'file': f'images/{source.name}'}
+        if 'renditions' in entry:
+            image_name = entry.get('preview', source.name)
+            item.update({'image': f'images/{image_name}', 'width': entry['image_width'],
+                         'height': entry['image_height'], 'thumb': f'thumbs/{image_name}',
+                         'thumb_width': entry['thumb_width'], 'thumb_height': entry['thumb_height'],
+                         'sources': [{'type': rendition['type'],
+                                      'srcset': ', '.join(f'images/{image_name}{extra} {width}w'
+                                                          for extra, width in rendition['images']),
+                                      'thumb': f'thumbs/{image_name}{rendition["thumb"]}'}
+                                     for rendition in entry['renditions']]})
+        return item
+
+    def _write_viewer(self, workdir, entries):
+        """Write album.json and the style's viewer page as index.html, which pages through the entries and
+        shows each one itself instead of there being a page for each
+
+        :param entries: from _json_entry
+        """
+        album = {'who': self.who.capitalize(), 'title': self.title, 'per_page': self._config.per_page,
+                 'thumb_size': self._config.thumbnail_size, 'image_size': self._config.image_size,
+                 'parent': '../index.html' if self.parent else None, 'albums': self._album_links(),
+                 'entries': entries}
+        self._write(Path(workdir) / ALBUM_JSON, json.dumps(album, separators=(',', ':')))
+        with self.profiler.stage('render page'):
+            content = self.environ.get_template('viewer.tmpl').render(title=self.title, who=self.who.capitalize(),
+                                                                      root=self._root())
+        self._write(Path(workdir) / 'index.html', content)
+
+    def _write(self, output, content):
+        """Write a page through the manifest, minified if it is HTML, timing it
+
+        :return: True if the page had changed and was written
+        """
+        start = time.perf_counter()
+        if Path(output).suffix == '.html':
+            content = minify_html(content)
+        written = self._manifest.write_page(output, content)
+        self.profiler.add('write page', time.perf_counter() - start, written=len(content) if written else 0)
+        self._precompress(output, written)
+        return written
+
+    def _precompress(self, file, changed):
+        """Write compressed copies of a file next to it if it changed or they are missing, or remove
+        them if precompress is turned off
+        """
+        if not self._config.precompress:
+            remove_compressed(file)
+        elif changed or not precompressed(file):
+            start = time.perf_counter()
+            written = precompress(file)
+            self.profiler.add('precompress', time.perf_counter() - start, written=written)
+
+    def _make_derivatives(self, files, executor=None):
+        """Make resized images and thumbnails, and copy movies and docs, in the executor's processes
+        if there is one. Work is submitted straight away so several albums can share the executor.
+
+        :param files: list of SourceFile to process
+        :param executor: BudgetedExecutor or None to make them in this process as the results are read
+        :return: iterator of (dimension dictionary, outputs, hash, Timings) in the same order as files
+        """
+        args = ([source.path for source in files], [source.name for source in files],
+                [source.file_type for source in files], [source.size for source in files], repeat(self.output_dir),
+                repeat(self._config.image_size), repeat(self._config.thumbnail_size),
+                repeat(self._config.link_mode), repeat(self._config.cache_dir if self._config.cache_mb else None),
+                repeat(self._formats()), repeat(self._config.image_scales), repeat(self._config.image_quality),
+                repeat(self._config.max_image_pixels), repeat(self._previews()), repeat(self._target_kb()),
+                [self._content_hashes.get(source.path) for source in files])
+        if executor is None or len(files) <= 1:
+            return map(make_derivatives, *args)
+        costs = [memory_cost(source.path, self._config.image_size, self._config.thumbnail_size,
+                             self._config.image_scales) if source.file_type == 'image' else 0 for source in files]
+        return executor.map(make_derivatives, *args, costs=costs)
+
+    def _executor(self):
+        """Process pool for making derivatives, or a context of None when only using one process
+        """
+        if self.jobs <= 1:
+            return nullcontext()
+        from scheduler import BudgetedExecutor
+        _logger.info(f"Using {self.jobs} processes with {self._config.memory_budget_mb} MB for images")
+        return BudgetedExecutor(self.jobs, self._config.memory_budget_mb * 1000000)
+
+    def _plan_derivatives(self, executor=None):
+        """Find which sources have changed since the last build and start making their derivatives
+        """
+        self._manifest = BuildManifest(self.output_dir, {'thumbnail_size': self._config.thumbnail_size,
+                                                         'image_size': self._config.image_size,
+                                                         'style': self._config.style,
+                                                         'link_mode': self._config.link_mode,
+                                                         'formats': self._formats(),
+                                                         'scales': self._config.image_scales,
+                                                         'quality': self._config.image_quality,
+                                                         'previews': self._previews(),
+                                                         'target_kb': self._target_kb(),
+                                                         'profile': OUTPUT_PROFILE})
+        current = {}
+        built = []
+        for source in self.files:
+            sizes = self._manifest.built_sizes(source)
+            if sizes is None:
+                built.append(source)
+            else:
+                current[source.path] = sizes
+        if self.files:
+            _logger.info(f"{len(built)} of {len(self.files)} files changed in {self.title}")
+        self._current = current
+        self._derived = self._make_derivatives(built, executor)
+
     def make_index(self, workdir):
         """
         """
+        if self._derived is None:
+            self._plan_derivatives()
+        derived, current = self._derived, self._current
+        self._derived = None
+        self.cover = None
+
         entries = []
         page_number = 0
-        for file_number, (file, file_type) in enumerate(self.files, start=1):
+        json_pages = self._config.page_mode == 'json'
+        for file_number, source in enumerate(self.files, start=1):
+            self.progress.check()
+            file_type = source.file_type
+            if source.path not in current:
+                with self.profiler.stage('wait for derivatives'):
+                    sizes, outputs, content_hash, timings = next(derived)
+                self.profiler.add_file(str(source.path), timings)
+                file_type = _entry_type(file_type, sizes)
+                outputs = [Path(output) for output in outputs]
+                referenced = file_type != 'image' and Path('images', source.name) not in outputs
+                self._manifest.record(source, sizes, outputs, content_hash, referenced)
+                _logger.info(f"Processed {source.name}")
+                if referenced:
+                    self._output_written(source.path, 'images', source.name)
+                for output in outputs:
+                    self._output_written(self.output_dir / output, output.parent.as_posix())
+            else:
+                sizes = current[source.path]
+                file_type = _entry_type(file_type, sizes)
+            link_text = source.path.relative_to(self.input_dir).as_posix()
             index_page = '../index.html' if page_number == 0 else f"../page{page_number}.html"
-            entry = {'type': file_type, 'link_text': file.name, 'img_number': file_number,
+            entry = {'type': file_type, 'link_text': link_text, 'img_number': file_number,
                      'next_image': f"image_{file_number+1}.html" if file_number < len(self.files) else None,
                      'prev_image': f"image_{file_number-1}.html" if file_number > 1 else None,
                      'total_images': len(self.files), 'index_page': index_page,
-                     'title': file.name}
+                     'title': link_text}
             entry['html_file'] = f'image_{file_number}.html'
             entry['link'] = f'images/{entry["html_file"]}'
-            self.make_image(file, entry, workdir)
-            if file_type == 'doc' or file_type == 'movie':
-                shutil.copy(file, self.image_dir)
+            entry.update(sizes)
+            if json_pages:
+                entry = self._json_entry(source, entry)
+            else:
+                self.make_image(source, entry, workdir)
+            if self.cover is None and file_type == 'image':
+                self.cover = entry['thumb']
             entries.append(entry)
-            if len(entries) == self._config.per_page:
-                self._write_page(workdir, entries, page_number, file_number == len(self.files) + 1)
+            self.progress.file_done()
+            if len(entries) == self._config.per_page and not json_pages:
+                self._write_page(workdir, entries, page_number, file_number == len(self.files))
                 entries = []
                 page_number += 1
-        if entries:
+        if json_pages:
+            self._write_viewer(workdir, entries)
+        elif entries or not self.files:
             self._write_page(workdir, entries, page_number, True)
+        with self.profiler.stage('save manifest'):
+            self._manifest.save()
+        if self._duplicates:
+            self._report_duplicates()
+        if self.cover is None:
+            self.cover = next((f'{album.album_dirname}/{album.cover}' for album in self.sub_albums if album.cover),
+                              None)
 
     def copy_resources(self, output_dir):
         """
@@ -147,57 +925,358 @@ class AlbumMaker:
         resource_target = output_dir / 'resources'
         resource_target.mkdir(exist_ok=True)
         for resource in resource_source.glob('*'):
-            shutil.copy(resource, resource_target)
+            target = resource_target / resource.name
+            copied = not (target.exists() and target.stat().st_size == resource.stat().st_size and
+                          target.stat().st_mtime == resource.stat().st_mtime)
+            if copied:
+                with self.profiler.stage('copy resources', written=resource.stat().st_size):
+                    shutil.copy2(resource, resource_target)
+            if resource.suffix in COMPRESSIBLE:
+                self._precompress(target, copied)
+
+    def _upload_base(self):
+        return self._config.target_directory + '/' + self.who + '/' + \
+            self.input_dir.name.lower().replace(' ', '')
 
-    def _create_remote_directory(self, sftp, directory):
+    def _make_uploader(self, delta, delete, connections):
+        delta = self._config.delta_upload if delta is None else delta
+        delete = self._config.delete_remote if delete is None else delete
+        from uploader import Uploader
+        return Uploader(self._config, delta=delta, delete=delete, connections=connections, progress=self.progress,
+                        profiler=self.profiler)
+
+    def _album_dirs(self):
+        """Output directories of this album and the sub albums in the scan, scanning if that hasn't been
+        done, sub albums before the album they are in
         """
+        if self.sub_albums is None:
+            self.scan_input_dir()
+        return [album.output_dir for album in self._all_albums()]
+
+    def _remove_old_sub_albums(self):
+        """Remove output directories of sub albums whose folder has gone from the input directory
         """
-        try:
-            sftp.stat(directory)
-        except Exception:
-            sftp.mkdir(directory)
-            _logger.info(f"Created {directory}")
+        current = {album.output_dir for album in self.sub_albums}
+        for directory in sorted(self.output_dir.iterdir()):
+            if directory.is_dir() and directory not in current and (directory / BuildManifest.FILENAME).exists():
+                _logger.info(f"Removing {directory}, its folder is no longer in {self.input_dir}")
+                shutil.rmtree(directory)
 
-    def upload(self):
-        """Upload directory to server
+    def _upload_remaining(self, uploader, upload_base):
+        """Upload whatever has not been sent yet, with the index pages last so they never link to missing files
         """
-        upload_base = self._config.target_directory + '/' + self.who + '/' + \
-            self.input_dir.name.lower().replace(' ', '')
-        _logger.info(f"Uploading to {upload_base}")
-        with paramiko.Transport((self._config.target_server, self._config.target_port)) as transport:
-            transport.connect(username=self._config.target_username, password=self._config.target_password)
-            with paramiko.SFTPClient.from_transport(transport) as sftp:
-                self._create_remote_directory(sftp, upload_base)
-                for file in self.output_dir.glob('*.html'):
-                    _logger.info(f"Uploading {file.name}")
-                    sftp.put(file, upload_base + f'/{file.name}')
-                for subdir in ['images', 'resources', 'thumbs']:
-                    self._create_remote_directory(sftp, upload_base + f'/{subdir}')
-                    src_dir = self.output_dir / Path(subdir)
-                    for file in src_dir.glob('*'):
-                        _logger.info(f"Uploading {file.name}")
-                        sftp.put(file, upload_base + f'/{subdir}/{file.name}')
+        album_dirs = self._album_dirs()
+        for album_dir in album_dirs:
+            album_base = '/'.join([upload_base, *album_dir.relative_to(self.output_dir).parts])
+            referenced = BuildManifest.referenced_files(album_dir)
+            for subdir in ['images', 'resources', 'thumbs']:
+                if (album_dir / subdir).is_dir():
+                    uploader.sync_directory(album_dir / Path(subdir), album_base + f'/{subdir}',
+                                            extra_files=referenced if subdir == 'images' else ())
+        uploader.run()
+        for album_dir in album_dirs:
+            album_base = '/'.join([upload_base, *album_dir.relative_to(self.output_dir).parts])
+            # Queue compressed copies before the pages, so an old copy is less likely to be sent with a new page
+            uploader.sync_directory(album_dir, album_base, f'{ALBUM_JSON}.*')
+            uploader.sync_directory(album_dir, album_base, ALBUM_JSON)
+            uploader.sync_directory(album_dir, album_base, '*.html.*')
+            uploader.sync_directory(album_dir, album_base, '*.html')
+            uploader.run()
+        # Sub albums whose folder has gone, once the pages no longer link to them
+        for album_dir in album_dirs:
+            album_base = '/'.join([upload_base, *album_dir.relative_to(self.output_dir).parts])
+            uploader.remove_old_directories(album_base, {'images', 'resources', 'thumbs',
+                                                         *(other.name for other in album_dirs
+                                                           if other.parent == album_dir)})
         url = self._config.target_url + upload_base + '/index.html'
         _logger.info(url)
         return url
 
-    def generate(self):
+    def _album_files(self):
+        """Every file _upload_remaining would upload
+
+        :return: iterator of (Path, path relative to the upload base)
         """
+        for album_dir in self._album_dirs():
+            prefix = ''.join(f'{part}/' for part in album_dir.relative_to(self.output_dir).parts)
+            for subdir in ['images', 'resources', 'thumbs']:
+                if (album_dir / subdir).is_dir():
+                    for file in sorted((album_dir / subdir).iterdir()):
+                        if file.is_file():
+                            yield file, f'{prefix}{subdir}/{file.name}'
+            for file, name in BuildManifest.referenced_files(album_dir):
+                yield file, f'{prefix}images/{name}'
+            for file in [*album_dir.glob(f'{ALBUM_JSON}*'), *sorted(album_dir.glob('*.html*'))]:
+                yield file, f'{prefix}{file.name}'
+
+    def upload(self, delta=None, delete=None, connections=None, bulk=None):
+        """Upload directory to server
+
+        :param delta: only upload files that differ from the remote copy, if None use the config
+        :param delete: remove remote files that are no longer in the album, if None use the config
+        :param connections: number of SFTP channels to upload on, if None use the config
+        :param bulk: send the whole album as one tar unpacked on the server and swapped into place, falling back
+            to sending files one at a time if the server doesn't allow it, if None use the config
+        """
+        bulk = self._config.bulk_upload if bulk is None else bulk
+        upload_base = self._upload_base()
+        _logger.info(f"Uploading to {upload_base}")
+        with self._make_uploader(delta, delete, connections) as uploader:
+            if bulk and uploader.bulk_upload(self._album_files(), upload_base, self._config.bulk_compress):
+                url = self._config.target_url + upload_base + '/index.html'
+                _logger.info(url)
+            else:
+                url = self._upload_remaining(uploader, upload_base)
+            uploader.log_summary()
+            return url
+
+    def publish(self, delta=None, delete=None, connections=None, uploader=None, bulk=None):
+        """Generate and upload together, each image is uploaded as soon as it has been made
+
+        :param delta: only upload files that differ from the remote copy, if None use the config
+        :param delete: remove remote files that are no longer in the album, if None use the config
+        :param connections: number of SFTP channels to upload on, if None use the config
+        :param uploader: open Uploader to publish with instead of connecting, delta, delete and connections
+            are then its own
+        :param bulk: generate it all and then upload it as one tar, see upload, if None use the config
+        """
+        if uploader is None and (self._config.bulk_upload if bulk is None else bulk):
+            self.generate()
+            return self.upload(delta, delete, connections, bulk=True)
+        if uploader is None:
+            with self._make_uploader(delta, delete, connections) as uploader:
+                return self.publish(uploader=uploader)
+        upload_base = self._upload_base()
+        _logger.info(f"Publishing to {upload_base}")
+        uploader.create_directory(upload_base)
+        self.on_output = lambda output, subdir, name: uploader.submit(output, upload_base + '/' + subdir, name)
+        try:
+            self.generate()
+            uploader.wait()
+        finally:
+            self.on_output = None
+        url = self._upload_remaining(uploader, upload_base)
+        uploader.log_summary()
+        return url
+
+    def _start(self, executor):
+        """Scan the album and start making the derivatives of it and its sub albums
+
+        :return: the albums to finish
         """
         self.scan_input_dir()
-        self.make_index(self.output_dir)
+        albums = list(self._all_albums())
+        if self._config.dedupe != 'off':
+            for album in albums:
+                album._find_duplicates(executor)
+        self.progress.add_files(sum(len(album.files) for album in albums))
+        # Start every album's work before waiting on any so independent sub albums are made in parallel
+        for album in albums:
+            album._plan_derivatives(executor)
+        return albums
+
+    def _finish(self, albums):
+        """Write the pages of the albums from _start as their derivatives are made, then the resources
+        """
+        for album in albums:
+            album.make_index(album.output_dir)
+            album._remove_old_sub_albums()
         self.copy_resources(self.output_dir)
 
+    def _evict_cache(self):
+        if self._config.cache_mb:
+            with self.profiler.stage('cache evict'):
+                DerivativeCache(self._config.cache_dir).evict(self._config.cache_mb * 1000000)
+
+    def generate(self):
+        """
+        """
+        with self._executor() as executor:
+            try:
+                self._finish(self._start(executor))
+            except Cancelled:
+                if executor is not None:
+                    executor.shutdown(cancel_futures=True)
+                raise
+        self._evict_cache()
+
+
+def _publish_watched(maker, uploader):
+    """Publish an album for watch, logging rather than raising a failure so watching carries on
+    """
+    try:
+        uploader.reset()
+        maker.progress = uploader.progress = Progress()
+        maker.publish(uploader=uploader)
+    except Exception:
+        _logger.exception(f"Publishing {maker.input_dir} failed, will try again when it next changes")
+
+
+def watch(makers, delta=True, delete=None, connections=None, settle=None, poll=False):
+    """Publish albums and then publish each again whenever files in its input directory are added, changed
+    or removed, until interrupted. Only the album that changed is made again, and one connection to the
+    server is kept open throughout.
+
+    :param makers: configured AlbumMaker for each input directory to watch
+    :param delta: only upload files that differ from the remote copy, on unless turned off as a rebuild
+        changes few files, if None use the config
+    :param delete: remove remote files that are no longer in the album, if None use the config
+    :param connections: number of SFTP channels to upload on, if None use the config
+    :param settle: seconds a directory must go without changes before it is published, if None use the config
+    :param poll: if True check for changes by listing the directories even when watchdog is installed
+    """
+    from watcher import DirectoryWatcher
+    config = makers[0]._config
+    settle = config.watch_settle if settle is None else settle
+    albums = {maker.input_dir.resolve(): maker for maker in makers}
+    # Watch before the first publish so nothing added while it runs is missed
+    with DirectoryWatcher(albums, settle, poll, config.watch_interval) as watcher, \
+            makers[0]._make_uploader(delta, delete, connections) as uploader:
+        for maker in makers:
+            _publish_watched(maker, uploader)
+        while True:
+            _logger.info(f"Watching {', '.join(str(maker.input_dir) for maker in makers)} for changes")
+            for directory in watcher.wait():
+                _publish_watched(albums[directory], uploader)
+
+
+def batch_albums(source, who=None):
+    """Albums to publish in a batch, from a yaml manifest or a directory laid out as who/album. The
+    manifest is a list of albums each with who, input_dir and optionally title, an input_dir that is
+    not absolute is relative to the manifest.
+
+    :param source: Path of the manifest or root directory
+    :param who: only the albums for this who, if None all of them
+    :return: list of (who, input_dir, title)
+    """
+    source = Path(source)
+    if source.is_dir():
+        albums = [(who_dir.name, album_dir, None) for who_dir in sub_directories(source)
+                  for album_dir in sub_directories(who_dir)]
+    else:
+        with source.open() as infile:
+            entries = yaml.safe_load(infile) or []
+        albums = [(str(entry['who']), source.parent / Path(entry['input_dir']).expanduser(), entry.get('title'))
+                  for entry in entries]
+    return [album for album in albums if who is None or album[0] == who]
+
+
+def batch(makers, delta=None, delete=None, connections=None):
+    """Publish many albums in one run. Every album's derivatives are made in one pool of processes and
+    uploaded over one connection, each album is finished and uploaded in turn while the pool carries on
+    with the later ones. An album that fails is logged and the rest are still published.
+
+    :param makers: configured AlbumMaker for each album
+    :param delta: only upload files that differ from the remote copy, if None use the config
+    :param delete: remove remote files that are no longer in the album, if None use the config
+    :param connections: number of SFTP channels to upload on, if None use the config
+    :return: list of (AlbumMaker, url or None if it failed, seconds from the start until it was published)
+    """
+    start = time.perf_counter()
+    first = makers[0]
+    for maker in makers[1:]:
+        maker.progress = first.progress
+    results = []
+    with first._executor() as executor, first._make_uploader(delta, delete, connections) as uploader:
+        try:
+            started = {}
+            for maker in makers:
+                upload_base = maker._upload_base()
+                try:
+                    uploader.create_directory(upload_base)
+                    maker.on_output = lambda output, subdir, name, upload_base=upload_base: \
+                        uploader.submit(output, upload_base + '/' + subdir, name)
+                    started[maker] = maker._start(executor)
+                except Cancelled:
+                    raise
+                except Exception:
+                    _logger.exception(f"Making {maker.input_dir} failed")
+            for maker in makers:
+                url = None
+                try:
+                    if maker in started:
+                        maker._finish(started[maker])
+                        url = maker._upload_remaining(uploader, maker._upload_base())
+                except Cancelled:
+                    raise
+                except Exception:
+                    _logger.exception(f"Publishing {maker.input_dir} failed")
+                finally:
+                    maker.on_output = None
+                results.append((maker, url, time.perf_counter() - start))
+        except Cancelled:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            raise
+        uploader.log_summary()
+    first._evict_cache()
+    published = sum(1 for _, url, _ in results if url)
+    _logger.info(f"Published {published} of {len(results)} albums in {time.perf_counter() - start:.1f}s "
+                 f"using {first.jobs} processes")
+    for maker, url, seconds in results:
+        _logger.info(f"{maker.who:<12}{maker.title:<32}{seconds:>8.1f}s  {url or 'FAILED'}")
+    return results
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
     parser = ArgumentParser()
-    parser.add_argument('who')
-    parser.add_argument('input_dir')
-    parser.add_argument('command', choices=['generate', 'upload'])
+    parser.add_argument('who', help="Who the album is for, with batch only this who's albums or all")
+    parser.add_argument('input_dir', help='Directory with the album, with batch a yaml manifest of albums or a '
+                                          'directory laid out as who/album')
+    parser.add_argument('command', choices=['generate', 'upload', 'publish', 'watch', 'batch'])
     parser.add_argument('--title')
     parser.add_argument('--config_file')
     parser.add_argument('--noupload', action='store_true')
+    parser.add_argument('--jobs', type=int, help='Number of processes for making images')
+    parser.add_argument('--delta', action='store_true', help='Only upload files that have changed')
+    parser.add_argument('--no_delta', action='store_true',
+                        help='With watch, upload every file each time rather than only those that have changed')
+    parser.add_argument('--delete', action='store_true', help='Delete remote files that are not in the album')
+    parser.add_argument('--connections', type=int, help='Number of SFTP channels to upload on')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Upload the album as one tar unpacked on the server, where it allows running tar')
+    parser.add_argument('--profile', nargs='?', const='profile', metavar='PREFIX',
+                        help='Time each stage and write the report to PREFIX.json, profile.json if no PREFIX')
+    parser.add_argument('--cprofile', action='store_true',
+                        help='With --profile also run under cProfile and write PREFIX.pstats, this process only')
+    parser.add_argument('--watch_dir', action='append', default=[],
+                        help='Another input directory for watch to publish as an album of its own, can be repeated')
+    parser.add_argument('--settle', type=float,
+                        help='Seconds watch waits for an input directory to stop changing before publishing it')
+    parser.add_argument('--poll', action='store_true',
+                        help='Have watch check for changes by listing the directories, for network shares')
     args = parser.parse_args()
-    maker = AlbumMaker().configure(args.config_file, args.input_dir, args.title, args.who)
-    getattr(maker, args.command)()
+    if args.command == 'batch':
+        albums = batch_albums(args.input_dir, None if args.who == 'all' else args.who)
+        if not albums:
+            parser.error(f"No albums found in {args.input_dir}")
+    else:
+        albums = [(args.who, args.input_dir, args.title)]
+        if args.command == 'watch':
+            albums += [(args.who, watch_dir, None) for watch_dir in args.watch_dir]
+    makers = [AlbumMaker().configure(args.config_file, input_dir, title, who, args.jobs)
+              for who, input_dir, title in albums]
+    profiler = Profiler(enabled=bool(args.profile), cprofile=args.cprofile)
+    for maker in makers:
+        maker.profiler = profiler
+    failed = False
+    with profiler.running():
+        if args.command == 'watch':
+            try:
+                watch(makers, delta=not args.no_delta, delete=args.delete or None, connections=args.connections,
+                      settle=args.settle, poll=args.poll)
+            except KeyboardInterrupt:
+                _logger.info("Stopped watching")
+        elif args.command == 'batch':
+            results = batch(makers, delta=args.delta or None, delete=args.delete or None,
+                            connections=args.connections)
+            failed = not all(url for _, url, _ in results)
+        elif args.command in ('upload', 'publish'):
+            getattr(makers[0], args.command)(delta=args.delta or None, delete=args.delete or None,
+                                             connections=args.connections, bulk=args.bulk or None)
+        else:
+            makers[0].generate()
+    profiler.save(args.profile)
+    if failed:
+        raise SystemExit(1)
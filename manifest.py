@@ -0,0 +1,143 @@
+import json
+import hashlib
+from pathlib import Path
+
+from compress import remove_compressed
+
+
+def file_hash(file):
+    """sha256 of a file's contents
+    """
+    digest = hashlib.sha256()
+    with open(file, 'rb') as infile:
+        for block in iter(lambda: infile.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class BuildManifest:
+    """Record of what has been built into an album output directory, so that unchanged sources
+    and pages can be skipped when generating again
+    """
+
+    FILENAME = '.manifest.json'
+
+    def __init__(self, output_dir, settings):
+        """
+        :param output_dir: album output directory, the manifest is stored here
+        :param settings: dictionary of the settings the derivatives are built with, if these differ
+                         from the stored ones everything is rebuilt
+        """
+        self._output_dir = Path(output_dir)
+        self._file = self._output_dir / self.FILENAME
+        self._settings = settings
+        self._sources = {}
+        self._pages = {}
+        # Outputs and pages built with different settings, removed on save if not built again
+        self._old_outputs = set()
+        self._old_pages = set()
+        if self._file.exists():
+            with self._file.open() as infile:
+                data = json.load(infile)
+            if data.get('settings') == settings:
+                self._sources = data.get('sources', {})
+                self._pages = data.get('pages', {})
+            else:
+                self._old_outputs = {output for record in data.get('sources', {}).values()
+                                     for output in record['outputs']}
+                self._old_pages = set(data.get('pages', {}))
+        self._seen_sources = set()
+        self._seen_pages = set()
+
+    def built_sizes(self, source):
+        """Check whether the derivatives of a source are up to date
+
+        :param source: SourceFile from the scan
+        :return: the stored dimensions if the source is unchanged and its outputs exist, otherwise None
+        """
+        key = str(source.path)
+        self._seen_sources.add(key)
+        record = self._sources.get(key)
+        if record is None or record.get('name') != source.name:
+            return None
+        if not all((self._output_dir / output).exists() for output in record['outputs']):
+            return None
+        if record['size'] != source.size:
+            return None
+        if record['mtime'] != source.mtime:
+            # Touched but maybe not changed
+            if record['hash'] != file_hash(source.path):
+                return None
+            record['mtime'] = source.mtime
+        return record['sizes']
+
+    def record(self, source, sizes, outputs, content_hash=None, referenced=False):
+        """Record that the derivatives of a source have been built
+
+        :param source: SourceFile from the scan
+        :param sizes: dimensions returned when the derivatives were made
+        :param outputs: paths of the derivatives relative to the output directory
+        :param content_hash: hash of the source if already known
+        :param referenced: True if the source itself is uploaded rather than a copy in the output directory
+        """
+        key = str(source.path)
+        self._seen_sources.add(key)
+        self._sources[key] = {'name': source.name, 'size': source.size, 'mtime': source.mtime,
+                              'hash': content_hash or file_hash(source.path), 'sizes': sizes,
+                              'outputs': [Path(output).as_posix() for output in outputs], 'referenced': referenced}
+
+    def output_size(self, source):
+        """Bytes uploaded for a source built in this run or an earlier one, its outputs and itself if referenced
+        """
+        record = self._sources.get(str(source.path))
+        if record is None:
+            return 0
+        size = sum((self._output_dir / output).stat().st_size for output in record['outputs']
+                   if (self._output_dir / output).exists())
+        return size + (source.size if record.get('referenced') else 0)
+
+    @classmethod
+    def referenced_files(cls, output_dir):
+        """Sources that are uploaded from where they are instead of from the output directory
+
+        :return: list of (Path, filename in the album)
+        """
+        manifest_file = Path(output_dir) / cls.FILENAME
+        if not manifest_file.exists():
+            return []
+        with manifest_file.open() as infile:
+            sources = json.load(infile).get('sources', {})
+        return [(Path(key), record['name']) for key, record in sources.items() if record.get('referenced')]
+
+    def write_page(self, output, content):
+        """Write a page only if its content differs from what was written last time
+
+        :param output: path of the page
+        :param content: text of the page
+        :return: True if the page was written
+        """
+        key = Path(output).relative_to(self._output_dir).as_posix()
+        self._seen_pages.add(key)
+        digest = hashlib.sha256(content.encode()).hexdigest()
+        if self._pages.get(key) == digest and Path(output).exists():
+            return False
+        with Path(output).open('w') as outfile:
+            outfile.write(content)
+        self._pages[key] = digest
+        return True
+
+    def save(self):
+        """Remove outputs of sources and pages not seen in this run and write the manifest
+        """
+        removed = [self._sources.pop(key) for key in set(self._sources) - self._seen_sources]
+        for key in (set(self._pages) | self._old_pages) - self._seen_pages:
+            self._pages.pop(key, None)
+            (self._output_dir / key).unlink(missing_ok=True)
+            remove_compressed(self._output_dir / key)
+        # A source that moved, such as a whole input directory, has outputs of the same names as before
+        current = {output for record in self._sources.values() for output in record['outputs']}
+        stale = {output for record in removed for output in record['outputs']} | self._old_outputs
+        for output in stale - current:
+            (self._output_dir / output).unlink(missing_ok=True)
+        with self._file.open('w') as outfile:
+            json.dump({'settings': self._settings, 'sources': self._sources, 'pages': self._pages}, outfile)
@@ -0,0 +1,133 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+_logger = logging.getLogger('maker')
+
+
+class Timings:
+    """Seconds and bytes read, written and sent per stage. Cheap enough to always collect, a worker process
+    makes one for each file and passes it back to be added to the Profiler.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        # Path of each image encoded to its bytes, quality and target bytes
+        self.encoded = {}
+
+    def add(self, name, seconds=0.0, read=0, written=0, sent=0):
+        stage = self.stages.setdefault(name, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                              'read': 0, 'written': 0, 'sent': 0})
+        stage['count'] += 1
+        stage['seconds'] += seconds
+        stage['max_seconds'] = max(stage['max_seconds'], seconds)
+        stage['read'] += read
+        stage['written'] += written
+        stage['sent'] += sent
+
+    @contextmanager
+    def stage(self, name, read=0, written=0, sent=0):
+        """Time the code in the with block as a stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, read, written, sent)
+
+
+class Profiler(Timings):
+    """Timings for a whole run, from any thread, with the timings of each file kept for the report.
+    Does nothing unless enabled.
+    """
+
+    def __init__(self, enabled=False, cprofile=False):
+        """
+        :param enabled: if False nothing is recorded
+        :param cprofile: if True also run under cProfile while running, only profiles this process
+        """
+        super().__init__()
+        self.enabled = enabled
+        self._cprofile = None
+        if enabled and cprofile:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+        self._lock = threading.Lock()
+        self._files = {}
+        self._seconds = 0.0
+
+    def add(self, name, seconds=0.0, read=0, written=0, sent=0):
+        if self.enabled:
+            with self._lock:
+                super().add(name, seconds, read, written, sent)
+
+    def stage(self, name, read=0, written=0, sent=0):
+        if not self.enabled:
+            return nullcontext()
+        return super().stage(name, read, written, sent)
+
+    def add_file(self, name, timings):
+        """Add the Timings for one source file from a worker, by its path
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._files[name] = {stage: round(values['seconds'], 6) for stage, values in timings.stages.items()}
+            self.encoded.update(timings.encoded)
+            for stage, values in timings.stages.items():
+                total = self.stages.setdefault(stage, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                       'read': 0, 'written': 0, 'sent': 0})
+                for key in ('count', 'seconds', 'read', 'written', 'sent'):
+                    total[key] += values[key]
+                total['max_seconds'] = max(total['max_seconds'], values['max_seconds'])
+
+    @contextmanager
+    def running(self):
+        """Time the whole run, under cProfile if asked for
+        """
+        start = time.perf_counter()
+        if self._cprofile is not None:
+            self._cprofile.enable()
+        try:
+            yield
+        finally:
+            if self._cprofile is not None:
+                self._cprofile.disable()
+            self._seconds += time.perf_counter() - start
+
+    def report(self):
+        """Dictionary of the timings for the JSON report
+        """
+        with self._lock:
+            return {'seconds': round(self._seconds, 6),
+                    'read': sum(stage['read'] for stage in self.stages.values()),
+                    'written': sum(stage['written'] for stage in self.stages.values()),
+                    'sent': sum(stage['sent'] for stage in self.stages.values()),
+                    'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                    'files': dict(self._files), 'encoded': dict(self.encoded)}
+
+    def save(self, prefix):
+        """Write the report to prefix.json, the cProfile stats to prefix.pstats, and log a summary table
+        """
+        if not self.enabled:
+            return
+        report = self.report()
+        with Path(f'{prefix}.json').open('w') as outfile:
+            json.dump(report, outfile, indent=1)
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(f'{prefix}.pstats')
+        _logger.info(f"Run took {report['seconds']:.2f}s, stages in worker processes are summed over the processes")
+        _logger.info(f"{'Stage':<24}{'Count':>7}{'Total s':>10}{'Max s':>9}{'Read MB':>10}{'Written MB':>12}"
+                     f"{'Sent MB':>10}")
+        for name, stage in sorted(report['stages'].items(), key=lambda item: item[1]['seconds'], reverse=True):
+            _logger.info(f"{name:<24}{stage['count']:>7}{stage['seconds']:>10.3f}{stage['max_seconds']:>9.3f}"
+                         f"{stage['read'] / 1e6:>10.1f}{stage['written'] / 1e6:>12.1f}{stage['sent'] / 1e6:>10.1f}")
+        encoded = report['encoded'].values()
+        if encoded:
+            over = sum(1 for image in encoded if image['target'] and image['bytes'] > image['target'])
+            _logger.info(f"Encoded {len(encoded)} images in {sum(image['bytes'] for image in encoded) / 1e6:.1f} MB, "
+                         f"{over} still over their target size at the lowest quality")
+        _logger.info(f"Report written to {prefix}.json")
@@ -0,0 +1,49 @@
+import threading
+
+
+class Cancelled(Exception):
+    """Raised between files when a job has been cancelled
+    """
+
+
+class Progress:
+    """Counts of files made and bytes uploaded, and the flag used to cancel a job. Updated from worker
+    threads and read by whatever is showing the progress.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self.files_done = 0
+        self.files_total = 0
+        self.bytes_done = 0
+        self.bytes_total = 0
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        """Raise Cancelled if the job has been cancelled
+        """
+        if self._cancelled.is_set():
+            raise Cancelled()
+
+    def add_files(self, total):
+        with self._lock:
+            self.files_total += total
+
+    def file_done(self):
+        with self._lock:
+            self.files_done += 1
+
+    def add_bytes(self, total):
+        with self._lock:
+            self.bytes_total += total
+
+    def bytes_sent(self, count):
+        with self._lock:
+            self.bytes_done += count
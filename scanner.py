@@ -0,0 +1,76 @@
+import os
+from collections import namedtuple
+from pathlib import Path
+
+SourceFile = namedtuple('SourceFile', ['path', 'name', 'file_type', 'size', 'mtime'])
+SourceFile.__doc__ = """A file found in the input directory
+
+:param path: Path of the source
+:param name: filename to use in the album, the path joined with _ and numbered if that clashes, as
+             a_b.jpg and a/b.jpg would
+:param file_type: 'image', 'movie' or 'doc'
+:param size: size in bytes from the scan
+:param mtime: modification time from the scan
+"""
+
+
+def suffix_types(config):
+    """Map of lower case file suffix to file type from the config
+    """
+    types = {}
+    for file_type, suffixes in (('doc', config.doc_suffix), ('movie', config.movie_suffix),
+                                ('image', config.image_suffix)):
+        types.update((suffix.lower(), file_type) for suffix in suffixes)
+    return types
+
+
+def _unique_name(name, names):
+    """name, or with _2, _3 and so on before its suffix if it is in names, which it is added to
+    """
+    stem, suffix = os.path.splitext(name)
+    number = 1
+    while name in names:
+        number += 1
+        name = f'{stem}_{number}{suffix}'
+    names.add(name)
+    return name
+
+
+def scan(input_dir, types, recursive=False):
+    """Yield the album files in a directory in name order, without listing more than one directory at a time.
+    Hidden files and directories are skipped.
+
+    :param input_dir: directory to scan
+    :param types: map of suffix to file type, see suffix_types
+    :param recursive: if True include sub directories, after the files of their parent
+    :return: iterator of SourceFile
+    """
+    input_dir = Path(input_dir)
+    pending = [input_dir]
+    names = set()
+    while pending:
+        directory = pending.pop()
+        with os.scandir(directory) as it:
+            entries = sorted((entry for entry in it if not entry.name.startswith('.')), key=lambda e: e.name)
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(Path(entry.path))
+                continue
+            file_type = types.get(os.path.splitext(entry.name)[1].lower())
+            if file_type is None or not entry.is_file():
+                continue
+            path = Path(entry.path)
+            name = _unique_name('_'.join(path.relative_to(input_dir).parts), names)
+            stat = entry.stat()
+            yield SourceFile(path, name, file_type, stat.st_size, stat.st_mtime)
+        if recursive:
+            pending.extend(reversed(subdirs))
+
+
+def sub_directories(input_dir):
+    """Sub directories of a directory in name order, hidden ones are skipped
+    """
+    with os.scandir(input_dir) as it:
+        return sorted((Path(entry.path) for entry in it if entry.is_dir() and not entry.name.startswith('.')),
+                      key=lambda path: path.name)
@@ -0,0 +1,103 @@
+import threading
+from collections import deque
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+
+
+class BudgetedExecutor:
+    """Process pool that only starts a task when the estimated memory of the tasks running with it fits in
+    a budget, so a few huge images are made one or two at a time while small ones fill all the processes.
+    A task bigger than the whole budget runs on its own. Tasks start in the order they are submitted.
+    """
+
+    def __init__(self, max_workers, budget):
+        """
+        :param max_workers: number of processes
+        :param budget: total estimated memory of the tasks running at once, in bytes
+        """
+        self._executor = ProcessPoolExecutor(max_workers=max_workers)
+        self._max_workers = max_workers
+        self._budget = budget
+        self._in_use = 0
+        self._running = 0
+        self._pending = deque()
+        self._condition = threading.Condition()
+        self._shutdown = False
+        self._feeder = threading.Thread(target=self._feed, daemon=True)
+        self._feeder.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def submit(self, cost, fn, *args):
+        """Queue a task to start when there is room in the budget
+
+        :param cost: estimated memory the task needs in bytes
+        :return: Future of its result
+        """
+        future = Future()
+        with self._condition:
+            self._pending.append((cost, fn, args, future))
+            self._condition.notify_all()
+        return future
+
+    def map(self, fn, *iterables, costs):
+        """Submit fn for each set of arguments straight away and return an iterator of the results in order
+
+        :param costs: estimated memory of each task
+        """
+        futures = [self.submit(cost, fn, *args) for cost, *args in zip(costs, *iterables)]
+        return (future.result() for future in futures)
+
+    def _feed(self):
+        """Start pending tasks as the budget allows, on a thread of its own so submit never waits
+        """
+        while True:
+            with self._condition:
+                while not self._shutdown and not (self._pending and self._fits(self._pending[0][0])):
+                    self._condition.wait()
+                if self._shutdown:
+                    return
+                cost, fn, args, future = self._pending.popleft()
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self._in_use += cost
+                self._running += 1
+            task = self._executor.submit(fn, *args)
+            task.add_done_callback(lambda task, cost=cost, future=future: self._finished(task, cost, future))
+
+    def _fits(self, cost):
+        """True if a task can start now, only as many are started as there are processes so that the
+        budget counts the tasks actually running
+        """
+        return self._running == 0 or (self._running < self._max_workers and self._in_use + cost <= self._budget)
+
+    def _finished(self, task, cost, future):
+        with self._condition:
+            self._in_use -= cost
+            self._running -= 1
+            self._condition.notify_all()
+        if task.cancelled():
+            future.set_exception(CancelledError())
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        """Stop starting tasks and shut the pool down
+
+        :param cancel_futures: if True cancel the tasks that have not started, otherwise wait for them all
+        """
+        if not cancel_futures:
+            with self._condition:
+                self._condition.wait_for(lambda: not self._pending or self._shutdown)
+        with self._condition:
+            self._shutdown = True
+            pending, self._pending = self._pending, deque()
+            self._condition.notify_all()
+        for _, _, _, future in pending:
+            future.cancel()
+        self._executor.shutdown(wait=wait, cancel_futures=cancel_futures)
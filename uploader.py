@@ -0,0 +1,497 @@
+import logging
+import shlex
+import stat
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+import paramiko
+
+from profiler import Profiler
+from progress import Progress
+
+_logger = logging.getLogger('maker')
+
+
+class Uploader:
+    """Upload directories to the configured server over SFTP, optionally only sending files that
+    differ from the remote copy by size or modification time.
+
+    Files are queued by sync_directory and sent by run over several SFTP channels on the one
+    transport, largest first so the small files fill in around the movies. Movies are written to
+    a .part file that is resumed after a dropped connection and renamed into place when complete.
+    """
+
+    BLOCK_SIZE = 256 * 1024
+    VERIFY_SIZE = 64 * 1024
+    MAX_BACKOFF = 30
+
+    def __init__(self, config, delta=False, delete=False, connections=None, progress=None, profiler=None):
+        """
+        :param config: AlbumMakerConfig with the target details
+        :param delta: if True skip files where the remote size and mtime match the local file
+        :param delete: if True remove remote files that are not present locally
+        :param connections: number of SFTP channels to upload on, if None use the config
+        :param progress: Progress to count bytes sent in and check for cancelling
+        :param profiler: Profiler to time the stages of uploading in
+        """
+        self._config = config
+        self.progress = progress or Progress()
+        self.profiler = profiler or Profiler()
+        self.delta = delta
+        self.delete = delete
+        self.connections = connections or config.upload_connections
+        self._queue = []
+        self._listings = {}
+        self._sent = set()
+        # Bytes of each file counted in the progress, so a retry doesn't count them again
+        self._counted = {}
+        self._executor = None
+        self._futures = []
+        self._local = threading.local()
+        self._clients = []
+        self._lock = threading.Lock()
+        self.upload_seconds = 0
+        self.files_sent = 0
+        self.bytes_sent = 0
+        self.files_skipped = 0
+        self.bytes_skipped = 0
+        self.files_deleted = 0
+
+    def __enter__(self):
+        self._connect()
+        return self
+
+    def _connect(self):
+        with self.profiler.stage('ssh connect'):
+            self._transport = paramiko.Transport((self._config.target_server, self._config.target_port))
+            self._transport.connect(username=self._config.target_username, password=self._config.target_password)
+            # Keep a connection held open between publishes by watch from being dropped as idle
+            self._transport.set_keepalive(30)
+            self._sftp = paramiko.SFTPClient.from_transport(self._transport)
+
+    def _reconnect(self, transport):
+        """Open a new transport if the one a worker was using has dropped, only the first worker to
+        notice does so
+        """
+        with self._lock:
+            if self._transport is transport and not transport.is_active():
+                _logger.info("Reconnecting")
+                transport.close()
+                self._connect()
+
+    def reset(self):
+        """Forget the remote listings, what has been sent and the counts so the uploader can publish again on
+        the same connection, reconnecting if it dropped while idle
+        """
+        self._listings = {}
+        self._sent = set()
+        self._counted = {}
+        self.upload_seconds = 0
+        self.files_sent = 0
+        self.bytes_sent = 0
+        self.files_skipped = 0
+        self.bytes_skipped = 0
+        self.files_deleted = 0
+        self._reconnect(self._transport)
+
+    def __exit__(self, *args):
+        self._close_channels()
+        self._sftp.close()
+        self._transport.close()
+
+    def _channel(self):
+        """SFTP client for the current worker thread, each has its own channel on the transport
+        """
+        client = getattr(self._local, 'sftp', None)
+        if client is not None and client.get_channel().get_transport() is not self._transport:
+            self._drop_channel()
+            client = None
+        if client is None:
+            with self.profiler.stage('open channel'):
+                client = paramiko.SFTPClient.from_transport(self._transport)
+            self._local.sftp = client
+            with self._lock:
+                self._clients.append(client)
+        return client
+
+    def _drop_channel(self):
+        """Close the current worker thread's SFTP client so the next attempt opens a fresh channel
+        """
+        client = getattr(self._local, 'sftp', None)
+        if client is not None:
+            self._local.sftp = None
+            with self._lock:
+                if client in self._clients:
+                    self._clients.remove(client)
+            try:
+                client.close()
+            except Exception:
+                pass
+
+    def _remote_listing(self, remote_dir):
+        """List a remote directory, creating it if it does not exist. Listed once per upload.
+
+        :return: dictionary of filename to SFTPAttributes
+        """
+        if remote_dir not in self._listings:
+            try:
+                with self.profiler.stage('list remote'):
+                    listing = self._sftp.listdir_attr(remote_dir)
+                self._listings[remote_dir] = {attr.filename: attr for attr in listing}
+            except IOError:
+                with self.profiler.stage('mkdir'):
+                    self._make_remote_dirs(remote_dir)
+                self._listings[remote_dir] = {}
+        return self._listings[remote_dir]
+
+    def _make_remote_dirs(self, remote_dir):
+        """Make a remote directory and any missing parents
+        """
+        try:
+            self._sftp.mkdir(remote_dir)
+        except IOError:
+            parent = remote_dir.rsplit('/', 1)[0]
+            if not parent or parent == remote_dir:
+                raise
+            self._make_remote_dirs(parent)
+            self._sftp.mkdir(remote_dir)
+        _logger.info(f"Created {remote_dir}")
+
+    def create_directory(self, remote_dir):
+        """Make sure a remote directory exists
+        """
+        self._remote_listing(remote_dir)
+
+    def _should_send(self, file, remote, name):
+        """Decide whether a file needs uploading, counting it as skipped if not
+
+        :param remote: listing of the remote directory
+        :param name: remote filename
+        """
+        if file in self._sent:
+            return False
+        local_stat = file.stat()
+        if self.delta and self._is_current(local_stat, remote.get(name)):
+            self.files_skipped += 1
+            self.bytes_skipped += local_stat.st_size
+            return False
+        return True
+
+    @staticmethod
+    def _is_current(local_stat, remote_attr):
+        """True if the remote file has the same size and modification time as the local one
+        """
+        return remote_attr is not None and stat.S_ISREG(remote_attr.st_mode or 0) and \
+            remote_attr.st_size == local_stat.st_size and remote_attr.st_mtime == int(local_stat.st_mtime)
+
+    def put(self, file, remote_file):
+        """Upload a single file with pipelined writes, keeping the local modification time
+        """
+        local_stat = file.stat()
+        sftp = self._channel()
+        start = time.perf_counter()
+        if file.suffix.lower() in self._config.movie_suffix:
+            sent = self._put_resumable(sftp, file, remote_file)
+        else:
+            _logger.info(f"Uploading {file.name}")
+            with file.open('rb') as infile, sftp.open(remote_file, 'wb') as outfile:
+                outfile.set_pipelined(True)
+                self._copy(file, infile, outfile, False)
+            sent = local_stat.st_size
+        self.profiler.add('put', time.perf_counter() - start, read=sent, sent=sent)
+        with self.profiler.stage('utime'):
+            sftp.utime(remote_file, (int(local_stat.st_atime), int(local_stat.st_mtime)))
+        with self._lock:
+            self.files_sent += 1
+            self.bytes_sent += sent
+
+    def _copy(self, file, infile, outfile, can_stop, position=0):
+        """Copy in blocks counting progress
+
+        :param can_stop: if True stop part way through when cancelled, used when the upload can be resumed
+        :param position: offset in the file the copy starts from
+        """
+        for block in iter(lambda: infile.read(self.BLOCK_SIZE), b''):
+            if can_stop:
+                self.progress.check()
+            outfile.write(block)
+            position += len(block)
+            self._count_progress(file, position)
+
+    def _count_progress(self, file, position):
+        """Count the bytes of a file up to position as sent, less any an earlier attempt already counted
+        """
+        with self._lock:
+            counted = self._counted.get(file, 0)
+            self._counted[file] = max(counted, position)
+        if position > counted:
+            self.progress.bytes_sent(position - counted)
+
+    def _resume_offset(self, sftp, file, part_file):
+        """Find how much of a file is already in the remote partial file
+
+        :return: offset to continue from, 0 if there is no usable partial file
+        """
+        try:
+            with self.profiler.stage('stat'):
+                part_size = sftp.stat(part_file).st_size
+        except IOError:
+            return 0
+        if not part_size or part_size > file.stat().st_size:
+            return 0
+        # Check the end of what was sent matches, a partial file from different content starts again
+        check_size = min(self.VERIFY_SIZE, part_size)
+        with file.open('rb') as infile, sftp.open(part_file, 'rb') as remote:
+            infile.seek(part_size - check_size)
+            remote.seek(part_size - check_size)
+            if infile.read(check_size) != remote.read(check_size):
+                return 0
+        return part_size
+
+    def _put_resumable(self, sftp, file, remote_file):
+        """Upload to a .part file, continuing from where an earlier attempt stopped, then rename it into place
+
+        :return: number of bytes sent
+        """
+        part_file = remote_file + '.part'
+        offset = self._resume_offset(sftp, file, part_file)
+        if offset:
+            _logger.info(f"Resuming {file.name} from {offset / 1e6:.1f} MB")
+        else:
+            _logger.info(f"Uploading {file.name}")
+        with file.open('rb') as infile, sftp.open(part_file, 'r+' if offset else 'wb') as outfile:
+            outfile.set_pipelined(True)
+            infile.seek(offset)
+            outfile.seek(offset)
+            self._count_progress(file, offset)
+            self._copy(file, infile, outfile, True, offset)
+        try:
+            sftp.posix_rename(part_file, remote_file)
+        except IOError:
+            # Server without the posix-rename extension, plain rename fails if the target exists
+            try:
+                sftp.remove(remote_file)
+            except IOError:
+                pass
+            sftp.rename(part_file, remote_file)
+        return file.stat().st_size - offset
+
+    def _put_with_retry(self, file, remote_file):
+        """Upload a file, retrying with backoff on a fresh channel, and connection if needed, when it fails
+        """
+        retries = self._config.upload_retries
+        for attempt in range(retries + 1):
+            self.progress.check()
+            transport = self._transport
+            try:
+                return self.put(file, remote_file)
+            except (IOError, EOFError, paramiko.SSHException) as e:
+                if attempt == retries:
+                    raise
+                delay = min(2 ** attempt, self.MAX_BACKOFF)
+                _logger.warning(f"Upload of {file.name} failed ({e}), retrying in {delay}s")
+                self._drop_channel()
+                time.sleep(delay)
+                if not transport.is_active():
+                    self._reconnect(transport)
+
+    def submit(self, file, remote_dir, name=None):
+        """Start uploading a file straight away, unless it is unchanged or already sent
+
+        :param file: Path of the local file
+        :param remote_dir: remote directory to upload it to, created if it does not exist
+        :param name: remote filename, if None the same as the local one
+        """
+        name = name or file.name
+        if not self._should_send(file, self._remote_listing(remote_dir), name):
+            return
+        self._sent.add(file)
+        self.progress.add_bytes(file.stat().st_size)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.connections)
+            self._start = time.perf_counter()
+        self._futures.append(self._executor.submit(self._put_with_retry, file, f'{remote_dir}/{name}'))
+
+    def wait(self):
+        """Wait for the submitted files to finish uploading, raising the first failure
+        """
+        if self._executor is None:
+            return
+        try:
+            with self.profiler.stage('wait for uploads'):
+                for future in self._futures:
+                    future.result()
+        finally:
+            self._executor.shutdown(cancel_futures=self.progress.cancelled)
+            self._executor = None
+            self._futures = []
+            self.upload_seconds += time.perf_counter() - self._start
+            self._close_channels()
+
+    def run(self):
+        """Upload the queued files, largest first, using self.connections channels
+        """
+        queue = sorted(self._queue, key=lambda task: task[0].stat().st_size, reverse=True)
+        self._queue = []
+        for file, remote_dir, name in queue:
+            self.submit(file, remote_dir, name)
+        self.wait()
+
+    def _close_channels(self):
+        """Close the per thread SFTP clients
+        """
+        with self._lock:
+            clients, self._clients = self._clients, []
+        for client in clients:
+            client.close()
+
+    def sync_directory(self, local_dir, remote_dir, pattern='*', extra_files=()):
+        """Queue the files in a local directory that match the pattern for upload by run,
+        subdirectories are not included
+
+        :param local_dir: Path of the local directory
+        :param remote_dir: remote directory, created if it does not exist
+        :param pattern: glob pattern of the files to upload and, when deleting, to consider on the remote side
+        :param extra_files: (Path, remote filename) of files from elsewhere to upload to the same remote directory
+        """
+        remote = self._remote_listing(remote_dir)
+        local_names = set()
+        # Partial files of uploads to resume
+        resuming = set()
+        for file, name in [*((file, file.name) for file in sorted(local_dir.glob(pattern))), *extra_files]:
+            if not file.is_file() or name in local_names:
+                continue
+            local_names.add(name)
+            if self._should_send(file, remote, name):
+                self._queue.append((file, remote_dir, name))
+                resuming.add(name + '.part')
+        if self.delete:
+            for name, attr in remote.items():
+                if name not in local_names | resuming and fnmatch(name, pattern) and \
+                        stat.S_ISREG(attr.st_mode or 0):
+                    _logger.info(f"Deleting remote {name}")
+                    with self.profiler.stage('delete remote'):
+                        self._sftp.remove(f'{remote_dir}/{name}')
+                    self.files_deleted += 1
+
+    def remove_old_directories(self, remote_dir, keep):
+        """When deleting, remove the subdirectories of a remote directory that are not in keep, with everything
+        in them. Only those with an index.html are removed, so folders put there some other way are left alone.
+
+        :param keep: names of the subdirectories to leave
+        """
+        if not self.delete:
+            return
+        for name, attr in self._remote_listing(remote_dir).items():
+            path = f'{remote_dir}/{name}'
+            if name not in keep and stat.S_ISDIR(attr.st_mode or 0) and 'index.html' in self._sftp.listdir(path):
+                _logger.info(f"Deleting remote {path}")
+                with self.profiler.stage('delete remote'):
+                    self._remove_tree(path)
+
+    def _remove_tree(self, remote_dir):
+        """Remove a remote directory and everything in it
+        """
+        for attr in self._sftp.listdir_attr(remote_dir):
+            path = f'{remote_dir}/{attr.filename}'
+            if stat.S_ISDIR(attr.st_mode or 0):
+                self._remove_tree(path)
+            else:
+                self._sftp.remove(path)
+                self.files_deleted += 1
+        self._sftp.rmdir(remote_dir)
+        self._listings.pop(remote_dir, None)
+
+    def _run(self, command):
+        """Run a shell command on the server
+
+        :return: exit status and stderr, status None if the server doesn't allow commands
+        """
+        try:
+            channel = self._transport.open_session()
+            channel.exec_command(command)
+            errors = channel.makefile_stderr('rb').read().decode(errors='replace').strip()
+            return channel.recv_exit_status(), errors
+        except paramiko.SSHException:
+            return None, ''
+
+    def bulk_upload(self, files, remote_dir, compress=False):
+        """Send files as one tar stream on one channel, unpacked by tar on the server into a staging directory
+        that then replaces remote_dir, so the album is never seen half uploaded. The swap is atomic if the
+        server's mv has --exchange, otherwise the album is missing for an instant. Everything is sent and
+        remote files that aren't in files are gone afterwards, whatever delta and delete are.
+
+        :param files: (Path, path relative to remote_dir) of each file
+        :param remote_dir: remote directory to replace
+        :param compress: if True gzip the stream, worth it on slow links with many pages
+        :return: False without sending anything if the server doesn't allow running tar, True when done
+        """
+        status, _ = self._run('tar --version')
+        if status != 0:
+            _logger.info("The server doesn't allow running tar, uploading files one at a time")
+            return False
+        staging, old = shlex.quote(remote_dir + '.staging'), shlex.quote(remote_dir + '.old')
+        target = shlex.quote(remote_dir)
+        files = list(files)
+        start = time.perf_counter()
+        channel = self._transport.open_session()
+        channel.exec_command(f"rm -rf {staging} {old} && mkdir -p {staging} && "
+                             f"tar -x{'z' if compress else ''}f - -C {staging}")
+        total = sum(file.stat().st_size for file, _ in files)
+        self.progress.add_bytes(total)
+        with channel.makefile('wb') as stream:
+            counted = _CountingWriter(stream, self.progress)
+            # Links made by link_mode are sent as the files they point at
+            with tarfile.open(fileobj=counted, mode='w|gz' if compress else 'w|', dereference=True,
+                              format=tarfile.PAX_FORMAT) as archive:
+                for file, name in files:
+                    _logger.info(f"Adding {name}")
+                    archive.add(file, arcname=name, recursive=False)
+        channel.shutdown_write()
+        errors = channel.makefile_stderr('rb').read().decode(errors='replace').strip()
+        if channel.recv_exit_status() != 0:
+            self._run(f'rm -rf {staging}')
+            raise IOError(f"Unpacking the upload into {remote_dir} failed: {errors}")
+        self.profiler.add('bulk upload', time.perf_counter() - start, read=total, sent=counted.count)
+        # Exchanging the two with one rename needs coreutils 9.5, otherwise with two renames the album isn't
+        # there for an instant between them
+        status, errors = self._run(f"if [ -e {target} ]; then "
+                                   f"if mv --exchange -T {staging} {target} 2>/dev/null; then rm -rf {staging}; "
+                                   f"else mv {target} {old} && mv {staging} {target} && rm -rf {old}; fi; "
+                                   f"else mv {staging} {target}; fi")
+        if status != 0:
+            raise IOError(f"Swapping {remote_dir} for the upload failed: {errors}")
+        self.upload_seconds += time.perf_counter() - start
+        self.files_sent += len(files)
+        self.bytes_sent += counted.count
+        return True
+
+    def log_summary(self):
+        """Log what was sent, skipped and deleted
+        """
+        rate = self.bytes_sent / self.upload_seconds / 1e6 if self.upload_seconds else 0
+        _logger.info(f"Uploaded {self.files_sent} files ({self.bytes_sent / 1e6:.1f} MB) in "
+                     f"{self.upload_seconds:.1f}s, {rate:.2f} MB/s over {self.connections} connections")
+        if self.delta:
+            _logger.info(f"Skipped {self.files_skipped} unchanged files ({self.bytes_skipped / 1e6:.1f} MB saved)")
+        if self.delete:
+            _logger.info(f"Deleted {self.files_deleted} remote files")
+
+
+class _CountingWriter:
+    """File object that counts the bytes written through it as sent and stops if cancelled
+    """
+
+    def __init__(self, stream, progress):
+        self._stream = stream
+        self._progress = progress
+        self.count = 0
+
+    def write(self, data):
+        self._progress.check()
+        self._stream.write(data)
+        self._progress.bytes_sent(len(data))
+        self.count += len(data)
+        return len(data)
@@ -0,0 +1,130 @@
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+_logger = logging.getLogger('maker')
+
+
+def _snapshot(directory):
+    """Size and modification time of every file and directory under a directory, hidden ones are skipped
+    """
+    snapshot = {}
+    pending = [directory]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as it:
+                for entry in it:
+                    if entry.name.startswith('.'):
+                        continue
+                    stat = entry.stat()
+                    snapshot[entry.path] = (stat.st_size, stat.st_mtime)
+                    if entry.is_dir():
+                        pending.append(entry.path)
+        except FileNotFoundError:
+            pass
+    return snapshot
+
+
+class DirectoryWatcher:
+    """Watch directories for files being added, changed or removed, using inotify and the like through
+    watchdog if it is installed, otherwise by listing them every few seconds. Changes are gathered
+    until a directory has been quiet for a while so a burst of new files is only reported once.
+    """
+
+    def __init__(self, directories, settle=5.0, poll=False, poll_interval=2.0):
+        """
+        :param directories: directories to watch, including their sub directories
+        :param settle: seconds a directory must go without changes before it is reported
+        :param poll: if True list the directories every poll_interval seconds even if watchdog is installed
+        """
+        self._directories = [Path(directory).resolve() for directory in directories]
+        self._settle = settle
+        self._poll = poll
+        self._poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+        self._stopped = threading.Event()
+        # Watched directory to the time of its latest change
+        self._pending = {}
+        self._observer = None
+
+    def __enter__(self):
+        if not self._poll:
+            try:
+                self._start_observer()
+                _logger.info("Watching for changes with watchdog")
+                return self
+            except ImportError:
+                _logger.info("watchdog is not installed, checking for changes every "
+                             f"{self._poll_interval:g}s instead")
+        threading.Thread(target=self._run_polling, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._stopped.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+
+    def _start_observer(self):
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.event_type not in ('opened', 'closed_no_write'):
+                    watcher._notify(event.src_path)
+                    if getattr(event, 'dest_path', None):
+                        watcher._notify(event.dest_path)
+
+        self._observer = Observer()
+        for directory in self._directories:
+            self._observer.schedule(Handler(), str(directory), recursive=True)
+        self._observer.start()
+
+    def _run_polling(self):
+        snapshots = {directory: _snapshot(directory) for directory in self._directories}
+        while not self._stopped.wait(self._poll_interval):
+            for directory in self._directories:
+                snapshot = _snapshot(directory)
+                if snapshot != snapshots[directory]:
+                    snapshots[directory] = snapshot
+                    self._notify(directory)
+
+    def _notify(self, path):
+        """Record a change to a path in one of the watched directories
+        """
+        path = Path(os.fsdecode(path))
+        for directory in self._directories:
+            if path == directory or directory in path.parents:
+                # Only hidden parts inside the watched directory, it may itself be under a hidden one
+                if any(part.startswith('.') for part in path.relative_to(directory).parts):
+                    continue
+                with self._lock:
+                    self._pending[directory] = time.monotonic()
+                self._changed.set()
+
+    def wait(self):
+        """Wait for one or more directories to change and then stay unchanged for the settle time
+
+        :return: list of the watched directories that changed
+        """
+        while True:
+            self._changed.wait()
+            with self._lock:
+                now = time.monotonic()
+                settled = [directory for directory, changed in self._pending.items()
+                           if now - changed >= self._settle]
+                for directory in settled:
+                    del self._pending[directory]
+                if not self._pending:
+                    self._changed.clear()
+                next_check = min((changed + self._settle - now for changed in self._pending.values()),
+                                 default=0)
+            if settled:
+                return settled
+            time.sleep(max(next_check, 0.1))